@@ -0,0 +1,218 @@
+import ast
+import json
+import re
+from typing import List, Literal, Optional, Union
+from pydantic import AliasChoices, BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+
+
+# Typed agent actions. Model replies (and actions echoed back by the client on
+# confirm) are parsed once into one of these models; the executor then reads
+# plain attributes instead of probing every alias a model might have used.
+
+
+def extract_json(text: str):
+    # First balanced JSON object in `text`, else the first array, else None.
+    # One forward scan tracks nesting depth and string state; each top-level
+    # candidate is parsed once, so the work is linear in the reply length.
+    if not text:
+        return None
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    depth = 0
+    start = None
+    quote = None
+    escaped = False
+    array = None  # first array seen; "Step [1]: {...}" still yields the object
+    for i, ch in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == quote:
+                quote = None
+        elif ch in '{[':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch in '}]' and depth:
+            depth -= 1
+            if depth == 0:
+                value = _loads(text[start:i + 1])
+                if isinstance(value, dict):
+                    return value
+                if array is None:
+                    array = value
+        elif depth and ch in '"\'':
+            # quotes only open strings inside a candidate, so apostrophes
+            # in surrounding prose ("Here's the action") are ignored
+            quote = ch
+    return array
+
+
+def _loads(s: str):
+    try:
+        return json.loads(s)
+    except ValueError:
+        pass
+    # Python-style literals ({'intent': 'move'}, True/None) parse as such;
+    # unlike rewriting quotes this keeps apostrophes inside names intact
+    try:
+        value = ast.literal_eval(s)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return value if isinstance(value, (dict, list)) else None
+
+
+class ActionError(ValueError):
+    pass
+
+
+class _Action(BaseModel):
+    model_config = ConfigDict(extra='ignore', populate_by_name=True)
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def _blank_is_missing(cls, v, info):
+        # "" and whitespace count as not given: the default, or an error if required
+        if isinstance(v, str) and not v.strip():
+            field = cls.model_fields[info.field_name]
+            if field.is_required():
+                raise ValueError("must not be empty")
+            return field.get_default(call_default_factory=True)
+        return v
+
+
+def _has_words(query: str) -> bool:
+    # a query without any word matches every file, so it never selects anything
+    return bool(re.search(r"\w", query or ''))
+
+
+class _QueryAction(_Action):
+    # query-driven actions touch every match; an empty query is refused
+    query: str
+
+    @field_validator('query')
+    @classmethod
+    def _query_has_words(cls, v):
+        if not _has_words(v):
+            raise ValueError("must contain a word to match file names")
+        return v
+
+
+class MoveFolderAction(_Action):
+    intent: Literal['move_folder'] = 'move_folder'
+    source_folder: str = Field(validation_alias=AliasChoices('source_folder', 'source'))
+    target_folder: str = Field(validation_alias=AliasChoices('target_folder', 'target'))
+
+
+class MoveImagesAction(_QueryAction):
+    intent: Literal['move_image']
+    target_folder: str = Field(validation_alias=AliasChoices('target_folder', 'target'))
+
+
+class RenameImageAction(_Action):
+    intent: Literal['rename_image']
+    folder: Optional[str] = None
+    old_name: str = Field(validation_alias=AliasChoices('old_name', 'filename', 'file', 'image'))
+    new_name: str
+
+
+class DeleteImagesAction(_QueryAction):
+    intent: Literal['delete_image']
+
+
+class TagAction(_Action):
+    intent: Literal['tag']
+    tags: List[str] = Field(default_factory=list, validation_alias=AliasChoices('tags', 'labels'))
+    filename: Optional[str] = Field(None, validation_alias=AliasChoices('filename', 'file', 'image'))
+    folder: Optional[str] = None
+    query: str = ''
+
+    @field_validator('tags', mode='before')
+    @classmethod
+    def _one_tag(cls, v):
+        return [v] if isinstance(v, str) else v
+
+    @model_validator(mode='after')
+    def _needs_target(self):
+        if not self.filename and not _has_words(self.query):
+            raise ValueError("needs a filename or a query with a word to match")
+        return self
+
+
+class SummarizeAction(_Action):
+    intent: Literal['summarize']
+    query: str = ''
+    folder: Optional[str] = None
+
+
+class DeleteFolderAction(_Action):
+    intent: Literal['delete_folder']
+    folder: str = Field(validation_alias=AliasChoices('folder', 'source_folder', 'target_folder'))
+    recursive: bool = False
+
+
+class DuplicatesAction(_Action):
+    intent: Literal['find_duplicates', 'delete_duplicates']
+    folder: Optional[str] = None
+    filename: Optional[str] = Field(None, validation_alias=AliasChoices('filename', 'file', 'image'))
+    max_distance: Optional[int] = Field(None, ge=0, le=64)
+
+
+Action = Union[MoveFolderAction, MoveImagesAction, RenameImageAction, DeleteImagesAction,
+               TagAction, SummarizeAction, DeleteFolderAction, DuplicatesAction]
+
+_action_models = {}
+for _model in Action.__args__:
+    for _intent in _model.model_fields['intent'].annotation.__args__:
+        _action_models[_intent] = _model
+
+# synonyms the model (or older clients) use for each canonical intent
+INTENT_ALIASES = {
+    'move': 'move_image',
+    'rename': 'rename_image',
+    'delete': 'delete_image',
+    'tag_image': 'tag',
+    'summary': 'summarize',
+    'remove_folder': 'delete_folder',
+    'rmdir': 'delete_folder',
+    'duplicates': 'find_duplicates',
+    'find_similar': 'find_duplicates',
+    'similar': 'find_duplicates',
+}
+
+
+def parse_action(data) -> Action:
+    # validated action model for a raw dict; raises ActionError with a short reason
+    if isinstance(data, _Action):
+        return data
+    if not isinstance(data, dict):
+        raise ActionError("action must be a JSON object")
+    data = dict(data)
+    intent = str(data.get('intent') or '').strip().lower()
+    intent = INTENT_ALIASES.get(intent, intent)
+    if (data.get('source_folder') or data.get('source')) and (data.get('target_folder') or data.get('target')) \
+            and intent in ('', 'move_image', 'move_folder'):
+        # a source/target folder pair without a more specific intent moves the whole folder
+        intent = 'move_folder'
+    if not intent:
+        raise ActionError("missing intent")
+    data['intent'] = intent
+    model = _action_models.get(intent)
+    if model is None:
+        raise ActionError(f"unknown intent: {intent}")
+    try:
+        return model.model_validate(data)
+    except ValidationError as e:
+        err = e.errors()[0]
+        field = '.'.join(str(p) for p in err.get('loc', ())) or 'action'
+        raise ActionError(f"{field}: {err.get('msg', 'invalid')}")
+
+
+def action_dict(action: Action) -> dict:
+    # plain dict for logs and client round-trips
+    return action.model_dump(exclude_none=True)
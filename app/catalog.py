@@ -0,0 +1,63 @@
+from pathlib import Path
+from app.libraries import current
+
+
+# Fan-out of tree mutations to the in-memory indexes of the current library.
+# Routes call these right after changing the filesystem (while still holding
+# their locks); every index implements whichever of the hook methods it cares
+# about. Each call is also appended to the library's journal so the other
+# workers apply the same change to their indexes.
+
+
+def _portable(root: Path, value):
+    # root-relative "a/b.jpg" for paths, so journal entries mean the same in
+    # every worker; other arguments (tag lists) pass through
+    if isinstance(value, Path):
+        try:
+            return value.relative_to(root).as_posix() if value.is_absolute() else value.as_posix()
+        except ValueError:
+            return str(value)
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def _emit(method, *args):
+    lib = current()
+    try:
+        lib.journal.append(method, [_portable(lib.images_root, a) for a in args])
+    except OSError:
+        pass
+    lib.apply(method, args)
+
+
+def add_folder(path):
+    _emit('add_folder', path)
+
+
+def add_file(path):
+    _emit('add_file', path)
+
+
+def remove_file(path):
+    _emit('remove_file', path)
+
+
+def move_file(src, dst):
+    _emit('move_file', src, dst)
+
+
+def set_tags(path, tags):
+    _emit('set_tags', path, list(tags or ()))
+
+
+def add_tree(path):
+    _emit('add_tree', path)
+
+
+def remove_tree(path):
+    _emit('remove_tree', path)
+
+
+def move_tree(src, dst):
+    _emit('move_tree', src, dst)
@@ -7,3 +7,21 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = Path(os.getenv("DATA_DIR", BASE_DIR / "data"))
+
+# Compiled templates are kept in memory; set TEMPLATE_AUTO_RELOAD=1 while
+# editing templates to have them picked up without a restart.
+TEMPLATE_AUTO_RELOAD = os.getenv("TEMPLATE_AUTO_RELOAD", "0").lower() in ("1", "true", "yes")
+# Upper bound on rendered gallery HTML kept in memory.
+FRAGMENT_CACHE_BYTES = int(os.getenv("FRAGMENT_CACHE_BYTES", 32 * 1024 * 1024))
+# Header naming the tenant whose library a request works on (set by the
+# fronting proxy); requests without it use the default library in DATA_DIR.
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant")
+# Shared secret the proxy sends in TENANT_TOKEN_HEADER with every request that
+# names a tenant; without it set, only the default library is served.
+TENANT_PROXY_TOKEN = os.getenv("TENANT_PROXY_TOKEN") or None
+TENANT_TOKEN_HEADER = os.getenv("TENANT_TOKEN_HEADER", "X-Tenant-Token")
+# Comma-separated tenants whose library may be created on first use; other
+# tenants are served only once their directory exists.
+TENANTS = frozenset(t.strip() for t in os.getenv("TENANTS", "").split(",") if t.strip())
+# Number of tenant libraries kept loaded; the least recently used is evicted.
+LIBRARY_CACHE_SIZE = int(os.getenv("LIBRARY_CACHE_SIZE", 16))
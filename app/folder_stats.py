@@ -0,0 +1,338 @@
+from collections import Counter
+from pathlib import Path
+import datetime
+import json
+import os
+import threading
+
+
+# Per-folder aggregates (file count, total bytes, newest upload, tag histogram).
+# Every folder node carries the totals of its whole subtree, so reads are O(1);
+# mutations walk only the ancestors of the touched path.
+
+
+class _Node:
+    __slots__ = ("children", "files", "count", "bytes", "newest", "tags")
+
+    def __init__(self):
+        self.children = {}  # name -> _Node
+        self.files = {}  # name -> (size, mtime, tags tuple)
+        self.count = 0
+        self.bytes = 0
+        self.newest = 0.0
+        self.tags = Counter()
+
+
+def relative_parts(root: Path, path):
+    # split an absolute path under `root` or a root-relative path/string into
+    # its parts; None for paths outside the library (hidden entries such as
+    # .trash and the action log, and the root tags.json metadata file)
+    p = Path(str(path).replace('\\', '/'))
+    if p.is_absolute():
+        try:
+            p = p.relative_to(root)
+        except ValueError:
+            return None
+    parts = [x for x in p.parts if x not in ('', '.', '/')]
+    if any(x.startswith('.') or x == '..' for x in parts):
+        return None
+    if parts == ['tags.json']:
+        return None
+    return parts
+
+
+def tags_of(entry):
+    # tags.json entries are either {"tags": [...], ...} or a legacy plain list
+    if isinstance(entry, dict):
+        entry = entry.get('tags')
+    if isinstance(entry, list):
+        return tuple(str(t) for t in entry)
+    return ()
+
+
+class FolderStats:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._tree = None
+        self._lock = threading.RLock()
+
+    # -- path helpers -----------------------------------------------------
+
+    def _parts(self, path):
+        return relative_parts(self.root, path)
+
+    def _walk(self, parts, create=False):
+        # return the chain of nodes from root to the folder at `parts`
+        node = self._root()
+        chain = [node]
+        for name in parts:
+            child = node.children.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[name] = _Node()
+            node = child
+            chain.append(node)
+        return chain
+
+    # -- building ---------------------------------------------------------
+
+    def _root(self):
+        if self._tree is None:
+            self._tree = self._build()
+        return self._tree
+
+    def _load_tags(self):
+        tags_file = self.root / 'tags.json'
+        try:
+            data = json.loads(tags_file.read_text())
+        except Exception:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _scan(self, node, directory: Path, prefix: str, tags_data: dict):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for e in entries:
+            if e.name.startswith('.') or (not prefix and e.name == 'tags.json'):
+                continue
+            rel = f"{prefix}{e.name}"
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    child = node.children[e.name] = _Node()
+                    self._scan(child, Path(e.path), rel + '/', tags_data)
+                    node.count += child.count
+                    node.bytes += child.bytes
+                    node.newest = max(node.newest, child.newest)
+                    node.tags.update(child.tags)
+                elif e.is_file():
+                    st = e.stat()
+                    tags = tags_of(tags_data.get(rel))
+                    node.files[e.name] = (st.st_size, st.st_mtime, tags)
+                    node.count += 1
+                    node.bytes += st.st_size
+                    node.newest = max(node.newest, st.st_mtime)
+                    node.tags.update(tags)
+            except OSError:
+                continue
+
+    def _build(self):
+        node = _Node()
+        if self.root.exists():
+            self._scan(node, self.root, '', self._load_tags())
+        return node
+
+    def invalidate(self):
+        # drop the in-memory tree; it is rebuilt from disk on next access
+        with self._lock:
+            self._tree = None
+
+    # -- aggregate maintenance -------------------------------------------
+
+    @staticmethod
+    def _recompute_newest(node):
+        newest = 0.0
+        for _size, mtime, _tags in node.files.values():
+            newest = max(newest, mtime)
+        for child in node.children.values():
+            newest = max(newest, child.newest)
+        node.newest = newest
+
+    def _apply(self, chain, count, size, newest, tags, removing):
+        if removing:
+            for node in chain:
+                node.count -= count
+                node.bytes -= size
+                node.tags.subtract(tags)
+                node.tags += Counter()  # drop zero/negative counts
+            # newest can only be recomputed bottom-up once children are final
+            for node in reversed(chain):
+                if newest >= node.newest:
+                    self._recompute_newest(node)
+        else:
+            for node in chain:
+                node.count += count
+                node.bytes += size
+                node.newest = max(node.newest, newest)
+                node.tags.update(tags)
+
+    # -- public mutation hooks --------------------------------------------
+
+    def add_folder(self, path):
+        parts = self._parts(path)
+        if parts is None:
+            return
+        with self._lock:
+            self._walk(parts, create=True)
+
+    def add_file(self, path, size=None, mtime=None, tags=None):
+        parts = self._parts(path)
+        if not parts:
+            return
+        if size is None or mtime is None:
+            try:
+                st = (self.root / Path(*parts)).stat()
+            except OSError:
+                return
+            size = st.st_size if size is None else size
+            mtime = st.st_mtime if mtime is None else mtime
+        with self._lock:
+            chain = self._walk(parts[:-1], create=True)
+            node = chain[-1]
+            # the old record leaves node.files before newest is recomputed
+            old = node.files.pop(parts[-1], None)
+            if old is not None:
+                if tags is None:
+                    tags = old[2]
+                self._apply(chain, 1, old[0], old[1], old[2], removing=True)
+            tags = tuple(tags or ())
+            node.files[parts[-1]] = (size, mtime, tags)
+            self._apply(chain, 1, size, mtime, tags, removing=False)
+
+    def remove_file(self, path):
+        parts = self._parts(path)
+        if not parts:
+            return None
+        with self._lock:
+            chain = self._walk(parts[:-1])
+            if chain is None:
+                return None
+            rec = chain[-1].files.pop(parts[-1], None)
+            if rec is not None:
+                self._apply(chain, 1, rec[0], rec[1], rec[2], removing=True)
+            return rec
+
+    def move_file(self, src, dst):
+        # keep size/mtime/tags of the moved record; files coming from untracked
+        # locations (e.g. the trash) are stat'ed at their destination instead
+        with self._lock:
+            rec = self.remove_file(src)
+            if rec is None:
+                self.add_file(dst)
+            else:
+                self.add_file(dst, size=rec[0], mtime=rec[1], tags=rec[2])
+
+    def set_tags(self, path, tags):
+        parts = self._parts(path)
+        if not parts:
+            return
+        with self._lock:
+            chain = self._walk(parts[:-1])
+            if chain is None:
+                return
+            rec = chain[-1].files.get(parts[-1])
+            if rec is None:
+                return
+            new = tuple(tags or ())
+            chain[-1].files[parts[-1]] = (rec[0], rec[1], new)
+            for node in chain:
+                node.tags.subtract(rec[2])
+                node.tags.update(new)
+                node.tags += Counter()
+
+    def remove_tree(self, path):
+        parts = self._parts(path)
+        if not parts:
+            return None
+        with self._lock:
+            chain = self._walk(parts[:-1])
+            if chain is None:
+                return None
+            node = chain[-1].children.pop(parts[-1], None)
+            if node is not None:
+                self._apply(chain, node.count, node.bytes, node.newest, node.tags, removing=True)
+            return node
+
+    def add_tree(self, path):
+        # index a directory that appeared from outside the hooks (restores, imports)
+        parts = self._parts(path)
+        if not parts:
+            return
+        with self._lock:
+            self.remove_tree(path)
+            node = _Node()
+            tags_data = self._load_tags()
+            self._scan(node, self.root / Path(*parts), '/'.join(parts) + '/', tags_data)
+            self._attach(parts, node)
+
+    def move_tree(self, src, dst):
+        dst_parts = self._parts(dst)
+        with self._lock:
+            node = self.remove_tree(src)
+            if node is None:
+                if dst_parts:
+                    self.add_tree(dst)
+                return
+            if dst_parts:
+                self._attach(dst_parts, node)
+
+    def _attach(self, parts, node):
+        chain = self._walk(parts[:-1], create=True)
+        chain[-1].children[parts[-1]] = node
+        self._apply(chain, node.count, node.bytes, node.newest, node.tags, removing=False)
+
+    # -- reads ------------------------------------------------------------
+
+    def iter_files(self, folder=None):
+        # relative paths of all indexed files under `folder`, without touching disk
+        return [rel for rel, _size, _mtime in self.iter_records(folder)]
+
+    def iter_records(self, folder=None):
+        # (relative path, size, mtime) of all indexed files under `folder`
+        parts = self._parts(folder or '')
+        if parts is None:
+            return []
+        with self._lock:
+            chain = self._walk(parts)
+            if chain is None:
+                return []
+            out = []
+            stack = [('/'.join(parts), chain[-1])]
+            while stack:
+                prefix, node = stack.pop()
+                for name, (size, mtime, _tags) in node.files.items():
+                    out.append((f"{prefix}/{name}" if prefix else name, size, mtime))
+                for name, child in node.children.items():
+                    stack.append((f"{prefix}/{name}" if prefix else name, child))
+            return out
+
+    def has_folder(self, folder):
+        parts = self._parts(folder or '')
+        if parts is None:
+            return False
+        with self._lock:
+            return self._walk(parts) is not None
+
+    def record(self, path):
+        # (size, mtime) of one indexed file, or None
+        parts = self._parts(path)
+        if not parts:
+            return None
+        with self._lock:
+            chain = self._walk(parts[:-1])
+            rec = chain[-1].files.get(parts[-1]) if chain else None
+            return (rec[0], rec[1]) if rec else None
+
+    def get(self, folder=None):
+        # aggregates for `folder` (root when empty); None if it is not indexed
+        parts = self._parts(folder or '')
+        if parts is None:
+            return None
+        with self._lock:
+            chain = self._walk(parts)
+            if chain is None:
+                return None
+            node = chain[-1]
+            newest = None
+            if node.newest:
+                newest = datetime.datetime.utcfromtimestamp(node.newest).isoformat() + 'Z'
+            return {
+                "files": node.count,
+                "direct_files": len(node.files),
+                "bytes": node.bytes,
+                "newest_upload": newest,
+                "tags": dict(node.tags.most_common()),
+            }
+
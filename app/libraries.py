@@ -0,0 +1,221 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+import os
+import re
+import stat
+import threading
+import anyio
+import hmac
+from fastapi import HTTPException
+from starlette.responses import PlainTextResponse
+from starlette.staticfiles import StaticFiles
+from app.config import DATA_DIR, FRAGMENT_CACHE_BYTES, LIBRARY_CACHE_SIZE, TENANT_HEADER, TENANT_PROXY_TOKEN, TENANT_TOKEN_HEADER, TENANTS
+from app.folder_stats import FolderStats
+from app.locks import Journal
+from app.phash import PHashIndex
+from app.templating import FragmentCache
+from app.timeline import TimelineIndex
+
+
+# One library per tenant. A library is a directory with the usual layout
+# (images/, locks/, index/, plans/, tmp/) plus the in-memory indexes built
+# from it. The default tenant keeps using DATA_DIR itself; every other tenant
+# lives under DATA_DIR/tenants/<name>.
+#
+# Libraries are loaded on first use and kept in an LRU of at most
+# LIBRARY_CACHE_SIZE entries, so memory follows the number of recently active
+# tenants rather than the total size of all libraries. The library of the
+# current request is held in a context variable; routes, locks and the catalog
+# read it through current().
+#
+# The tenant header is only trusted together with the proxy token, and only
+# tenants that already exist or are listed in TENANTS are served, so a client
+# can neither reach another tenant's library nor create new ones.
+
+DEFAULT_TENANT = "default"
+_TENANT = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,63}")
+
+
+class Library:
+    def __init__(self, tenant: str, data_dir: Path):
+        self.tenant = tenant
+        self.data_dir = Path(data_dir)
+        self.images_root = self.data_dir / "images"
+        self.lock_dir = self.data_dir / "locks"
+        self.plan_dir = self.data_dir / "plans"
+        self.tmp_dir = self.data_dir / "tmp"
+        self.trash_dir = self.images_root / ".trash"
+        self.log_file = self.images_root / ".ai_action_log.jsonl"
+        for d in (self.images_root, self.lock_dir, self.plan_dir, self.tmp_dir, self.trash_dir):
+            d.mkdir(parents=True, exist_ok=True)
+
+        self.stats = FolderStats(self.images_root)
+        self.phash = PHashIndex(self.images_root, self.data_dir / "index" / "phash.npz", self.stats)
+        self.timeline = TimelineIndex(self.images_root, self.data_dir / "index" / "timeline.bin", self.stats)
+        self.fragments = FragmentCache(self.images_root, FRAGMENT_CACHE_BYTES)
+        # catalog hooks fan out to these, in this order
+        self.indexes = [self.stats, self.phash, self.timeline, self.fragments]
+        # mutations of other workers arrive through the journal
+        self.journal = Journal(self.lock_dir / "journal", self.apply, self.invalidate)
+        self.journal.sync()
+
+    def apply(self, method, args):
+        # run one catalog hook on every index
+        for index in self.indexes:
+            fn = getattr(index, method, None)
+            if fn is None:
+                continue
+            try:
+                fn(*args)
+            except Exception:
+                # an index falling behind must never fail the mutation itself;
+                # drop it so it is rebuilt from disk on next use
+                try:
+                    index.invalidate()
+                except Exception:
+                    pass
+
+    def invalidate(self):
+        for index in self.indexes:
+            index.invalidate()
+
+    def sync(self):
+        # replay what other workers changed; called once per request and
+        # after taking locks, so index lookups themselves never touch disk
+        self.journal.sync()
+
+    def close(self):
+        # called on eviction: persist what is worth keeping; requests still
+        # holding this library keep working on its indexes until they finish
+        # and the object is collected
+        for index in (self.phash, self.timeline):
+            try:
+                index.flush()
+            except Exception:
+                pass
+
+
+def clean_tenant(name):
+    # tenant name or None; names become directory names, so keep them plain
+    if name is None or name == "":
+        return DEFAULT_TENANT
+    s = str(name).strip()
+    return s if _TENANT.fullmatch(s) else None
+
+
+def tenant_dir(tenant: str) -> Path:
+    if tenant == DEFAULT_TENANT:
+        return Path(DATA_DIR)
+    return Path(DATA_DIR) / "tenants" / tenant
+
+
+def tenant_known(tenant: str) -> bool:
+    return tenant == DEFAULT_TENANT or tenant in TENANTS or tenant_dir(tenant).is_dir()
+
+
+_loaded = OrderedDict()  # tenant -> Library, least recently used first
+_loaded_guard = threading.Lock()
+
+
+def get_library(tenant: str = DEFAULT_TENANT) -> Library:
+    with _loaded_guard:
+        lib = _loaded.get(tenant)
+        if lib is not None:
+            _loaded.move_to_end(tenant)
+            return lib
+    lib = Library(tenant, tenant_dir(tenant))
+    evicted = []
+    with _loaded_guard:
+        # another request may have loaded it meanwhile; keep the first one
+        lib = _loaded.setdefault(tenant, lib)
+        _loaded.move_to_end(tenant)
+        while len(_loaded) > max(LIBRARY_CACHE_SIZE, 1):
+            evicted.append(_loaded.popitem(last=False)[1])
+    for old in evicted:
+        # requests still using an evicted library keep their reference; the
+        # next request for that tenant simply loads it again
+        old.close()
+    return lib
+
+
+_current = ContextVar("library", default=None)
+
+
+def current() -> Library:
+    lib = _current.get()
+    return lib if lib is not None else get_library(DEFAULT_TENANT)
+
+
+@contextmanager
+def using(lib: Library):
+    token = _current.set(lib)
+    try:
+        yield lib
+    finally:
+        _current.reset(token)
+
+
+class LibraryMiddleware:
+    # binds the library named by the tenant header (set by the fronting proxy)
+    # for the duration of each request
+    def __init__(self, app):
+        self.app = app
+        self.header = TENANT_HEADER.lower().encode('latin-1')
+        self.token_header = TENANT_TOKEN_HEADER.lower().encode('latin-1')
+
+    def _trusted(self, headers) -> bool:
+        # the tenant header counts only when the proxy vouches for it
+        token = headers.get(self.token_header)
+        return TENANT_PROXY_TOKEN is not None and token is not None and hmac.compare_digest(token, TENANT_PROXY_TOKEN.encode('latin-1'))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or ())
+        raw = headers.get(self.header)
+        tenant = clean_tenant(raw.decode('latin-1') if raw is not None else None)
+        if tenant is None:
+            await PlainTextResponse("invalid tenant", status_code=400)(scope, receive, send)
+            return
+        if tenant != DEFAULT_TENANT and not self._trusted(headers):
+            await PlainTextResponse("tenant not allowed", status_code=403)(scope, receive, send)
+            return
+        if not await anyio.to_thread.run_sync(tenant_known, tenant):
+            await PlainTextResponse("unknown tenant", status_code=404)(scope, receive, send)
+            return
+        # loading reads the journal and evicting flushes indexes to disk
+        lib = await anyio.to_thread.run_sync(get_library, tenant)
+        if lib.journal.behind():
+            # replaying may stat or scan files; keep it off the event loop
+            await anyio.to_thread.run_sync(lib.sync)
+        with using(lib):
+            await self.app(scope, receive, send)
+
+
+class LibraryFiles(StaticFiles):
+    # /images of the current library; the root is picked per request, the
+    # rest (conditional GET, HEAD, content types) is StaticFiles' own
+    def __init__(self):
+        super().__init__(directory=None, check_dir=False)
+
+    @staticmethod
+    def _lookup(root: Path, path: str):
+        directory = os.path.realpath(root)
+        full_path = os.path.realpath(os.path.join(directory, path))
+        if os.path.commonpath([full_path, directory]) != directory:
+            return "", None
+        try:
+            return full_path, os.stat(full_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return "", None
+
+    async def get_response(self, path: str, scope):
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+        full_path, stat_result = await anyio.to_thread.run_sync(self._lookup, current().images_root, path)
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            raise HTTPException(status_code=404)
+        return self.file_response(full_path, stat_result, scope)
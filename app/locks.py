@@ -0,0 +1,333 @@
+from contextlib import contextmanager
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+# fcntl is POSIX-only; without it locks only coordinate threads of one process
+try:
+    import fcntl
+except Exception:
+    fcntl = None
+
+
+# Cross-process locks for filesystem mutations (several uvicorn workers share
+# one tree). Each lock is an flock() on a small file in the locks/ directory
+# of the current library; libraries of different tenants never contend.
+#
+# Folders are locked hierarchically so unrelated folders proceed in parallel:
+#   - a file-level change in folder X takes the folder nodes of X and all its
+#     ancestors shared, plus X's file lock exclusively;
+#   - a whole-tree change of X (delete/rename folder) takes the ancestors
+#     shared and X's folder node exclusively, which waits for anything running
+#     inside X or below it.
+# Metadata files (tags.json, the action log) have their own exclusive locks.
+#
+# All keys of one `locked()` call are acquired in a fixed global order
+# (folder nodes, folder files, tags, action log), so nested calls are only
+# allowed to add keys that sort after the ones already held.
+
+TAGS = "tags"
+ACTION_LOG = "action_log"
+_META_RANK = {TAGS: 2, ACTION_LOG: 3}
+
+_SHARED = 1
+_EXCLUSIVE = 2
+
+_local = threading.local()
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _norm(folder):
+    if not folder:
+        return ""
+    parts = [p for p in str(folder).replace('\\', '/').split('/') if p and p != '.']
+    return '/'.join(parts)
+
+
+def _ancestors(folder):
+    # "", "a", "a/b" for folder "a/b/c"
+    parts = folder.split('/') if folder else []
+    return ['/'.join(parts[:i]) for i in range(len(parts))]
+
+
+def _held():
+    held = getattr(_local, 'held', None)
+    if held is None:
+        held = _local.held = {}
+    return held
+
+
+def _lock_path(lock_dir: Path, key):
+    digest = hashlib.sha1(repr(key).encode('utf8')).hexdigest()[:20]
+    return lock_dir / f"{digest}.lock"
+
+
+class _KeyLock:
+    # one lock key held by the current thread: an flock()ed fd when fcntl is
+    # available, otherwise a per-process threading lock
+    def __init__(self, lock_dir, key, mode):
+        self.lock_dir = lock_dir
+        self.key = key
+        self.mode = mode
+        self.fd = None
+        self.tlock = None
+
+    def acquire(self):
+        if fcntl is not None:
+            self.fd = os.open(str(_lock_path(self.lock_dir, self.key)), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX if self.mode == _EXCLUSIVE else fcntl.LOCK_SH)
+            except Exception:
+                os.close(self.fd)
+                self.fd = None
+                raise
+        else:
+            with _thread_locks_guard:
+                self.tlock = _thread_locks.setdefault((self.lock_dir, self.key), threading.RLock())
+            self.tlock.acquire()
+
+    def release(self):
+        if self.fd is not None:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self.fd)
+                self.fd = None
+        if self.tlock is not None:
+            self.tlock.release()
+            self.tlock = None
+
+
+@contextmanager
+def locked(files_in=(), trees=(), meta=(), library=None):
+    # files_in: folders whose direct files are created/moved/deleted
+    # trees: folders that are removed, renamed or restored as a whole
+    # meta: metadata files (TAGS, ACTION_LOG) that are rewritten
+    # library: defaults to the library of the current request
+    if library is None:
+        from app.libraries import current  # imports this module
+        library = current()
+    lock_dir = library.lock_dir
+    wanted = {}
+
+    def want(key, mode):
+        wanted[key] = max(wanted.get(key, 0), mode)
+
+    for folder in files_in:
+        f = _norm(folder)
+        for a in _ancestors(f) + [f]:
+            want((0, a), _SHARED)
+        want((1, f), _EXCLUSIVE)
+    for folder in trees:
+        f = _norm(folder)
+        for a in _ancestors(f):
+            want((0, a), _SHARED)
+        want((0, f), _EXCLUSIVE)
+    for name in meta:
+        want((_META_RANK[name], name), _EXCLUSIVE)
+
+    held = _held()
+    acquired = []
+    try:
+        for key in sorted(wanted):
+            mode = wanted[key]
+            if (lock_dir, key) in held:
+                # re-entrant use from a nested call; upgrading would deadlock
+                if held[(lock_dir, key)].mode < mode:
+                    raise RuntimeError(f"cannot upgrade lock {key!r} to exclusive")
+                continue
+            lk = _KeyLock(lock_dir, key, mode)
+            lk.acquire()
+            held[(lock_dir, key)] = lk
+            acquired.append(lk)
+        if acquired:
+            # whatever other workers finished while we waited is visible now
+            library.sync()
+        yield
+    finally:
+        for lk in reversed(acquired):
+            held.pop((lk.lock_dir, lk.key), None)
+            lk.release()
+
+
+JOURNAL_SEGMENT_BYTES = 4 * 1024 * 1024
+JOURNAL_SEGMENTS_KEPT = 4
+_NEXT = "next"  # last entry of a full segment
+
+
+class Journal:
+    # Append-only log of catalog mutations, shared by the workers of one
+    # library. A worker applies its own mutations to its indexes directly and
+    # appends them here; the other workers replay the entries they have not
+    # seen yet through the same hooks, so their indexes stay incremental too.
+    #
+    # The log is split into segments named after the sequence number of their
+    # first entry. A full segment ends with a "next" entry and only the last
+    # JOURNAL_SEGMENTS_KEPT segments are kept; a worker that fell behind so
+    # far that its segment is gone starts again at the end and rebuilds its
+    # indexes from disk.
+    def __init__(self, directory: Path, replay, reset):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._replay = replay  # fn(op, args) for entries of other workers
+        self._reset = reset  # fn() when entries were lost
+        self._segment = None  # first sequence number of the segment being read
+        self._offset = 0  # bytes of that segment already applied
+        self._seq = 0  # entries applied so far
+        self._guard = threading.RLock()
+
+    def _path(self, segment):
+        return self.dir / f"{segment:016x}.log"
+
+    def _segments(self):
+        out = []
+        for entry in os.scandir(self.dir):
+            name, _, ext = entry.name.partition('.')
+            if ext == 'log':
+                try:
+                    out.append(int(name, 16))
+                except ValueError:
+                    pass
+        return sorted(out)
+
+    def _start(self):
+        # position at the end of the newest segment
+        segments = self._segments()
+        self._segment = segments[-1] if segments else 0
+        self._path(self._segment).touch()
+        data = self._path(self._segment).read_bytes()
+        end = data.rfind(b'\n') + 1
+        self._offset = end
+        self._seq = self._segment + data.count(b'\n', 0, end)
+        if data[:end].endswith(json.dumps([_NEXT]).encode('utf8') + b'\n'):
+            # rotated, but the next segment was not created yet
+            self._seq -= 1
+            self._segment, self._offset = self._seq, 0
+            self._path(self._segment).touch()
+
+    def _pull(self):
+        # replay everything appended after our position
+        while True:
+            try:
+                with open(self._path(self._segment), 'rb') as f:
+                    f.seek(self._offset)
+                    data = f.read()
+            except FileNotFoundError:
+                self._lost()
+                return
+            end = data.rfind(b'\n') + 1  # a line being written is left for later
+            for line in data[:end].splitlines():
+                self._offset += len(line) + 1
+                try:
+                    op, *args = json.loads(line)
+                except ValueError:
+                    self._lost()
+                    return
+                if op == _NEXT:
+                    self._segment, self._offset = self._seq, 0
+                    break
+                self._seq += 1
+                self._replay(op, args[0] if args else [])
+            else:
+                return
+
+    def _lost(self):
+        self._start()
+        self._reset()
+
+    def behind(self):
+        # cheap check (one stat) whether sync() has anything to do
+        if self._segment is None:
+            return True
+        try:
+            return os.stat(self._path(self._segment)).st_size > self._offset
+        except OSError:
+            return True
+
+    def sync(self):
+        try:
+            with self._guard:
+                if self._segment is None:
+                    self._start()
+                elif self.behind():
+                    self._pull()
+        except OSError:
+            pass
+
+    def position(self):
+        # number of mutations recorded so far, the same in every worker
+        self.sync()
+        return self._seq
+
+    def since(self, position):
+        # [(op, args)] recorded after `position`, or None when some of those
+        # entries were already rotated away
+        segments = self._segments()
+        if not segments:
+            return []
+        older = [s for s in segments if s <= position]
+        if not older:
+            return None
+        segment, out = older[-1], []
+        while True:
+            try:
+                data = self._path(segment).read_bytes()
+            except FileNotFoundError:
+                return None
+            seq, following = segment, None
+            for line in data[:data.rfind(b'\n') + 1].splitlines():
+                try:
+                    op, *args = json.loads(line)
+                except ValueError:
+                    return None
+                if op == _NEXT:
+                    following = seq
+                    break
+                if seq >= position:
+                    out.append((op, args[0] if args else []))
+                seq += 1
+            if following is None:
+                return out
+            segment = following
+
+    @contextmanager
+    def _exclusive(self):
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(str(self.dir / "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def append(self, op, args):
+        # record one of our own mutations; entries of others that came before
+        # it are replayed first so positions stay in order
+        line = json.dumps([op, args], ensure_ascii=False).encode('utf8') + b'\n'
+        with self._guard, self._exclusive():
+            if self._segment is None:
+                self._start()
+            else:
+                self._pull()
+            with open(self._path(self._segment), 'ab') as f:
+                f.write(line)
+            self._offset += len(line)
+            self._seq += 1
+            if self._offset >= JOURNAL_SEGMENT_BYTES:
+                self._rotate()
+
+    def _rotate(self):
+        with open(self._path(self._segment), 'ab') as f:
+            f.write(json.dumps([_NEXT]).encode('utf8') + b'\n')
+        self._segment, self._offset = self._seq, 0
+        self._path(self._segment).touch()
+        for old in self._segments()[:-JOURNAL_SEGMENTS_KEPT]:
+            try:
+                self._path(old).unlink()
+            except OSError:
+                pass
@@ -1,8 +1,8 @@
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import RedirectResponse
-from app.routes import images, agent
-from fastapi.templating import Jinja2Templates
+from app.routes import images, agent, archives
+from app.libraries import LibraryFiles, LibraryMiddleware
 from pathlib import Path
 import os
 
@@ -12,10 +12,11 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = Path(os.getenv("DATA_DIR", BASE_DIR / "data"))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-# Mount saved images as static files
-images_dir = DATA_DIR / "images"
-images_dir.mkdir(parents=True, exist_ok=True)
-app.mount("/images", StaticFiles(directory=str(images_dir)), name="images")
+# Every request works on the library of its tenant (see app.libraries)
+app.add_middleware(LibraryMiddleware)
+
+# Mount saved images of the request's library as static files
+app.mount("/images", LibraryFiles(), name="images")
 
 # Mount local static assets (CSS/JS) from the `app/static` directory
 # (the JS/CSS in this project live under app/static)
@@ -23,12 +24,10 @@ static_dir = BASE_DIR / "app" / "static"
 static_dir.mkdir(parents=True, exist_ok=True)
 app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
 
-# Templates
-templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
-
 # Include routers
 app.include_router(images.router)
 app.include_router(agent.router)
+app.include_router(archives.router)
 
 
 @app.get("/")
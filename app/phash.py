@@ -0,0 +1,479 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from pathlib import Path
+import mimetypes
+import os
+import threading
+from app.folder_stats import relative_parts
+
+# optional Pillow/NumPy imports; without them similarity search is disabled
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+
+# Perceptual hashes (64-bit DCT pHash) for near-duplicate detection.
+#
+# Hashes live in a packed uint64 array. Lookups use multi-index hashing: the
+# hash is split into four 16-bit chunks and each chunk column is kept sorted.
+# Two hashes within Hamming distance D share at least one chunk that differs
+# in at most D // 4 bits, so enumerating those chunk variants and verifying the
+# candidates is exact and touches only a tiny slice of the index.
+#
+# Recent additions/removals are kept in a small delta (scanned linearly) and
+# folded into the sorted arrays once it grows past REBUILD_THRESHOLD (or a
+# quarter of the index, so a large backfill does not rebuild all the time).
+#
+# Files the stored index does not know yet are hashed by background jobs;
+# queries never wait for hashing and answer from what is indexed so far.
+
+CHUNKS = 4
+CHUNK_BITS = 16
+REBUILD_THRESHOLD = 4096
+SAVE_EVERY = 256
+BACKFILL_BATCH = 1024
+DEFAULT_SIMILAR_DISTANCE = 8
+# exact chunk buckets find every pair up to CHUNKS - 1 differing bits
+DEFAULT_DUPLICATE_DISTANCE = CHUNKS - 1
+
+_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="phash")
+
+
+def available():
+    return Image is not None and np is not None
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    m[0] /= np.sqrt(2)
+    return m * np.sqrt(2 / n)
+
+
+_DCT32 = _dct_matrix(32) if np is not None else None
+
+
+def compute_phash(path: Path):
+    # classic pHash: 32x32 grayscale -> 2D DCT -> top-left 8x8 (minus DC)
+    # compared to its median; returns an int or None for unreadable files
+    if not available():
+        return None
+    try:
+        with Image.open(path) as img:
+            img.draft('L', (64, 64))  # let JPEG decode at reduced scale
+            small = img.convert('L').resize((32, 32), Image.LANCZOS)
+    except Exception:
+        return None
+    a = np.asarray(small, dtype=np.float64)
+    low = (_DCT32 @ a @ _DCT32.T)[:8, :8].ravel()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def _popcount(a):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(a)
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return table[a.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _chunk(h, c):
+    return (h >> (CHUNK_BITS * c)) & ((1 << CHUNK_BITS) - 1)
+
+
+def _variants(value, radius):
+    # all CHUNK_BITS-wide values within `radius` bit flips of value
+    out = [value]
+    for r in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), r):
+            v = value
+            for b in bits:
+                v ^= 1 << b
+            out.append(v)
+    return out
+
+
+def _is_image(rel):
+    mime = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+    return mime.startswith("image/")
+
+
+class PHashIndex:
+    def __init__(self, root: Path, store: Path, stats):
+        self.root = Path(root)
+        self.store = Path(store)
+        self.stats = stats  # FolderStats of the same root; lists files without walking disk
+        self._entries = None  # rel -> hash; the source of truth
+        self._lock = threading.RLock()
+        self._unsaved = 0
+        self._loads = 0  # bumped on every (re)load; stale backfill jobs check it
+        self._backfilling = 0  # background hashing jobs still running
+        self._reset_arrays()
+
+    def _reset_arrays(self):
+        self._paths = []
+        self._hashes = None
+        self._row = {}
+        self._sorted = []  # per chunk: (sorted chunk values, row order)
+        self._delta = {}
+        self._removed = set()
+        self._groups = {}  # (folder prefix, max_distance) -> duplicates() result
+
+    def _rel(self, path):
+        parts = relative_parts(self.root, path)
+        return '/'.join(parts) if parts else None
+
+    # -- persistence --------------------------------------------------------
+
+    def _load(self):
+        entries = {}
+        try:
+            with np.load(self.store) as z:
+                paths = bytes(z['paths']).decode('utf8').split('\n') if len(z['paths']) else []
+                entries = dict(zip(paths, (int(h) for h in z['hashes'])))
+        except Exception:
+            entries = {}
+        return entries
+
+    def save(self):
+        if not available():
+            return
+        with self._lock:
+            if self._entries is None:
+                return
+            paths = list(self._entries)
+            hashes = np.fromiter((self._entries[p] for p in paths), dtype=np.uint64, count=len(paths))
+            blob = np.frombuffer('\n'.join(paths).encode('utf8'), dtype=np.uint8)
+            self._unsaved = 0
+        self.store.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.store.with_name(f"{self.store.name}.{os.getpid()}.tmp")
+        with tmp.open('wb') as f:
+            np.savez(f, paths=blob, hashes=hashes)
+        os.replace(tmp, self.store)
+
+    def flush(self):
+        # save only if there are changes not yet on disk
+        if self._unsaved:
+            self.save()
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+            self._reset_arrays()
+
+    def _ensure(self, wait=False):
+        # load the stored hashes and reconcile them with the library tree:
+        # drop entries for files that are gone, hash files that are missing
+        # (in the background unless `wait`)
+        with self._lock:
+            if self._entries is not None:
+                return
+            entries = self._load()
+        files = [rel for rel in self.stats.iter_files() if _is_image(rel)]
+        present = set(files)
+        entries = {rel: h for rel, h in entries.items() if rel in present}
+        missing = [rel for rel in files if rel not in entries]
+        if wait:
+            for i in range(0, len(missing), BACKFILL_BATCH):
+                batch = missing[i:i + BACKFILL_BATCH]
+                for rel, h in zip(batch, _pool.map(lambda r: compute_phash(self.root / r), batch)):
+                    if h is not None:
+                        entries[rel] = h
+        with self._lock:
+            self._entries = entries
+            self._loads += 1
+            self._reset_arrays()
+            self._rebuild()
+            batches = [] if wait else [missing[i:i + BACKFILL_BATCH] for i in range(0, len(missing), BACKFILL_BATCH)]
+            self._backfilling = len(batches)
+            for batch in batches:
+                _pool.submit(self._hash_batch, batch, self._loads)
+        if missing and wait:
+            self.save()
+
+    def _hash_batch(self, rels, load):
+        found = [(rel, compute_phash(self.root / rel)) for rel in rels]
+        with self._lock:
+            if load != self._loads or self._entries is None:
+                return
+            for rel, h in found:
+                # hooks may have hashed, moved or deleted it meanwhile
+                if h is not None and rel not in self._entries and (self.root / rel).exists():
+                    self._store(rel, h)
+            self._backfilling -= 1
+            done = not self._backfilling
+        if done:
+            self.save()
+
+    def backfill(self):
+        if not available():
+            return 0
+        self.invalidate()
+        self._ensure(wait=True)
+        return len(self._entries or {})
+
+    # -- array maintenance --------------------------------------------------
+
+    def _rebuild(self):
+        self._paths = list(self._entries)
+        self._hashes = np.fromiter((self._entries[p] for p in self._paths), dtype=np.uint64, count=len(self._paths))
+        self._row = {p: i for i, p in enumerate(self._paths)}
+        self._sorted = []
+        for c in range(CHUNKS):
+            col = _chunk(self._hashes, np.uint64(c)).astype(np.uint16) if len(self._hashes) else np.zeros(0, dtype=np.uint16)
+            order = np.argsort(col, kind='stable')
+            self._sorted.append((col[order], order))
+        self._delta = {}
+        self._removed = set()
+
+    def _store(self, rel, h):
+        if self._entries is None:
+            return
+        self._entries[rel] = h
+        if rel in self._row:
+            self._removed.add(rel)
+        self._delta[rel] = h
+        self._changed()
+
+    def _drop(self, rel):
+        if self._entries is None or self._entries.pop(rel, None) is None:
+            return None
+        self._delta.pop(rel, None)
+        if rel in self._row:
+            self._removed.add(rel)
+        self._changed()
+        return True
+
+    def _changed(self):
+        self._groups = {}
+        if len(self._delta) + len(self._removed) > max(REBUILD_THRESHOLD, len(self._paths) // 4):
+            self._rebuild()
+        self._unsaved += 1
+        # a running backfill saves once when it is done
+        if self._unsaved >= SAVE_EVERY and not self._backfilling:
+            _pool.submit(self.save)
+
+    # -- catalog hooks --------------------------------------------------------
+
+    def add_file(self, path):
+        # hash in the background; returns the pool future (None when skipped)
+        rel = self._rel(path)
+        if not rel or not available() or not _is_image(rel):
+            return None
+        return _pool.submit(self._hash_and_store, rel)
+
+    def _hash_and_store(self, rel):
+        full = self.root / rel
+        h = compute_phash(full)
+        if h is None:
+            return
+        with self._lock:
+            # the file may have been moved or deleted while we were hashing
+            if full.exists():
+                self._store(rel, h)
+
+    def remove_file(self, path):
+        rel = self._rel(path)
+        if rel:
+            with self._lock:
+                self._drop(rel)
+
+    def move_file(self, src, dst):
+        src_rel, dst_rel = self._rel(src), self._rel(dst)
+        with self._lock:
+            h = self._entries.get(src_rel) if self._entries is not None and src_rel else None
+            if src_rel:
+                self._drop(src_rel)
+            if h is not None and dst_rel:
+                self._store(dst_rel, h)
+                return
+        if dst_rel:
+            self.add_file(dst)
+
+    def _under(self, prefix):
+        prefix = prefix + '/'
+        return [rel for rel in self._entries if rel.startswith(prefix)]
+
+    def remove_tree(self, path):
+        rel = self._rel(path)
+        if not rel:
+            return
+        with self._lock:
+            if self._entries is None:
+                return
+            for r in self._under(rel):
+                self._drop(r)
+
+    def move_tree(self, src, dst):
+        src_rel, dst_rel = self._rel(src), self._rel(dst)
+        if not src_rel or not dst_rel:
+            self.invalidate()
+            return
+        with self._lock:
+            if self._entries is None:
+                return
+            for r in self._under(src_rel):
+                h = self._entries[r]
+                self._drop(r)
+                self._store(dst_rel + r[len(src_rel):], h)
+
+    def add_tree(self, path):
+        rel = self._rel(path)
+        if not rel:
+            return
+        for r in self.stats.iter_files(rel):
+            self.add_file(r)
+
+    # -- queries ------------------------------------------------------------
+
+    def _candidates(self, h, max_distance):
+        radius = max_distance // CHUNKS
+        rows = []
+        for c, (values, order) in enumerate(self._sorted):
+            if not len(values):
+                continue
+            vs = np.array(_variants(int(_chunk(h, c)), radius), dtype=np.uint16)
+            lo = np.searchsorted(values, vs, side='left')
+            hi = np.searchsorted(values, vs, side='right')
+            for a, b in zip(lo, hi):
+                if b > a:
+                    rows.append(order[a:b])
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(rows))
+
+    def _neighbours(self, h, max_distance):
+        out = []
+        rows = self._candidates(h, max_distance)
+        if len(rows):
+            dist = _popcount(self._hashes[rows] ^ np.uint64(h))
+            for r, d in zip(rows[dist <= max_distance], dist[dist <= max_distance]):
+                rel = self._paths[r]
+                if rel not in self._removed:
+                    out.append((rel, int(d)))
+        if self._delta:
+            rels = list(self._delta)
+            dist = _popcount(np.fromiter(self._delta.values(), dtype=np.uint64, count=len(rels)) ^ np.uint64(h))
+            out.extend((rels[i], int(dist[i])) for i in np.flatnonzero(dist <= max_distance))
+        return out
+
+    def similar(self, path, max_distance=DEFAULT_SIMILAR_DISTANCE, limit=50):
+        # images within `max_distance` bits of `path`, nearest first; None when
+        # the image is unknown or hashing is unavailable
+        if not available():
+            return None
+        rel = self._rel(path)
+        self._ensure()
+        with self._lock:
+            h = self._entries.get(rel) if rel else None
+            if h is None:
+                return None
+            found = [(r, d) for r, d in self._neighbours(h, max_distance) if r != rel]
+        found.sort(key=lambda x: (x[1], x[0]))
+        return [{"file": r, "distance": d} for r, d in found[:limit]]
+
+    def duplicates(self, folder=None, max_distance=DEFAULT_DUPLICATE_DISTANCE):
+        # groups of near-identical images (optionally only under `folder`).
+        # Candidate pairs come from rows sharing an exact chunk value, which
+        # finds every pair up to CHUNKS - 1 bits apart; larger distances only
+        # find pairs that happen to share a chunk. Results are kept until the
+        # index changes.
+        if not available():
+            return None
+        self._ensure()
+        prefix = None
+        if folder:
+            f = self._rel(folder)
+            if f is None:
+                return []
+            prefix = f + '/'
+        with self._lock:
+            if self._delta or self._removed:
+                self._rebuild()
+            key = (prefix, max_distance)
+            groups = self._groups.get(key)
+            if groups is None:
+                groups = self._groups[key] = self._duplicate_groups(prefix, max_distance)
+        return [list(g) for g in groups]
+
+    def _duplicate_groups(self, prefix, max_distance):
+        paths = self._paths
+        if prefix is None:
+            rows = np.arange(len(paths))
+        else:
+            rows = np.array([i for i, p in enumerate(paths) if p.startswith(prefix)], dtype=np.int64)
+        if len(rows) < 2:
+            return []
+        # identical hashes group for free; pairs are searched among distinct ones
+        uniq, inverse = np.unique(self._hashes[rows], return_inverse=True)
+        a, b = _close_pairs(uniq, max_distance)
+        label = _components(len(uniq), a, b)[inverse.ravel()]
+        order = np.argsort(label, kind='stable')
+        label, rows = label[order], rows[order]
+        starts = np.flatnonzero(np.r_[True, label[1:] != label[:-1]])
+        ends = np.r_[starts[1:], len(label)]
+        groups = [sorted(paths[r] for r in rows[s:e]) for s, e in zip(starts, ends) if e - s > 1]
+        groups.sort(key=lambda g: g[0])
+        return groups
+
+
+def _close_pairs(hashes, max_distance):
+    # (a, b) index arrays of all pairs within max_distance that share a chunk.
+    # Per chunk the hashes are sorted by chunk value; pairing every row with
+    # the one k places further inside the same run, for k = 1, 2, ..., walks
+    # each run's pairs with one vectorised step per k.
+    found_a, found_b = [], []
+    pos = np.arange(len(hashes))
+    for c in range(CHUNKS):
+        col = _chunk(hashes, np.uint64(c)).astype(np.uint16)
+        order = np.argsort(col, kind='stable')
+        values = col[order]
+        starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+        lengths = np.diff(np.r_[starts, len(values)])
+        end = np.repeat(starts + lengths, lengths)
+        active = pos[end - pos > 1]
+        k = 1
+        while len(active):
+            a, b = order[active], order[active + k]
+            close = _popcount(hashes[a] ^ hashes[b]) <= max_distance
+            found_a.append(a[close])
+            found_b.append(b[close])
+            k += 1
+            active = active[end[active] - active > k]
+    if not found_a:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(found_a), np.concatenate(found_b)
+
+
+def _components(n, a, b):
+    # connected-component label (smallest member) of each of n nodes joined by
+    # edges (a, b): hook larger roots under smaller ones, then compress paths
+    label = np.arange(n)
+    while len(a):
+        la, lb = label[a], label[b]
+        differ = la != lb
+        if not differ.any():
+            break
+        a, b, la, lb = a[differ], b[differ], la[differ], lb[differ]
+        np.minimum.at(label, np.maximum(la, lb), np.minimum(la, lb))
+        while True:
+            jumped = label[label]
+            if (jumped == label).all():
+                break
+            label = jumped
+    return label
+
+
+if __name__ == '__main__':
+    # offline backfill: python -m app.phash [tenant]
+    import sys
+    from app.libraries import DEFAULT_TENANT, clean_tenant, get_library
+    tenant = clean_tenant(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_TENANT)
+    if tenant is None:
+        sys.exit("invalid tenant name")
+    print(f"indexed {get_library(tenant).phash.backfill()} images")
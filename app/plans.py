@@ -0,0 +1,109 @@
+from pathlib import Path
+import json
+import os
+import re
+import time
+import uuid
+from app.libraries import current
+
+
+# Server-side store for previewed agent actions. A preview resolves the files
+# an action will touch once and saves that list in the plans/ directory of the
+# current library together with the journal position it was computed at;
+# confirming sends back only the plan id. Plans are small JSON files so any
+# worker can execute a plan another worker previewed, and taking one is an
+# atomic rename so it runs only once.
+
+PLAN_TTL = 15 * 60  # seconds a preview stays confirmable
+
+_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def _path(plan_id: str) -> Path:
+    return current().plan_dir / f"{plan_id}.json"
+
+
+def _prune(now: float):
+    try:
+        entries = list(os.scandir(current().plan_dir))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if now - entry.stat().st_mtime > PLAN_TTL:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def position() -> int:
+    # journal position to pass to create(); read it before computing the
+    # preview so changes made while previewing make the plan stale
+    return current().journal.position()
+
+
+def create(action: dict, items, preview: dict, position: int) -> dict:
+    # store a plan and return it; `items` is the resolved [src, dst] list or None
+    now = time.time()
+    _prune(now)
+    plan = {
+        "id": uuid.uuid4().hex,
+        "position": position,
+        "created": now,
+        "action": action,
+        "items": items,
+        "preview": preview,
+    }
+    tmp = current().plan_dir / f".{plan['id']}.tmp"
+    tmp.write_text(json.dumps(plan, ensure_ascii=False), encoding='utf8')
+    os.replace(tmp, _path(plan["id"]))
+    return plan
+
+
+def take(plan_id) -> dict:
+    # remove and return a stored plan, or None if unknown, expired or already taken
+    if not isinstance(plan_id, str) or not _ID.fullmatch(plan_id):
+        return None
+    claimed = current().plan_dir / f".{plan_id}.taken"
+    try:
+        os.rename(_path(plan_id), claimed)
+    except OSError:
+        return None
+    try:
+        plan = json.loads(claimed.read_text(encoding='utf8'))
+    except (OSError, ValueError):
+        return None
+    finally:
+        try:
+            claimed.unlink()
+        except OSError:
+            pass
+    if time.time() - plan.get("created", 0) > PLAN_TTL:
+        return None
+    return plan
+
+
+def is_current(plan: dict) -> bool:
+    # True if nothing in the library changed since the plan was made
+    return plan.get("position") == current().journal.position()
+
+
+def changes(plan: dict):
+    # (files, folders) the catalog touched since the plan was made, as
+    # root-relative paths; None if that is no longer known (journal rotated)
+    entries = current().journal.since(plan.get("position", 0))
+    if entries is None:
+        return None
+    files, folders = set(), set()
+    for op, args in entries:
+        if op == 'set_tags':
+            continue
+        paths = folders if op == 'add_folder' or op.endswith('_tree') else files
+        for arg in args:
+            if not isinstance(arg, str):
+                continue
+            if arg in ('', '.'):
+                # the whole library
+                return None
+            paths.add(arg)
+    return files, folders
@@ -0,0 +1,117 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+from app.libraries import current
+
+
+# Central name validation for every route. Folder and file names coming from
+# clients (forms, JSON bodies, agent actions) are normalized once into typed
+# handles; existence checks go to the in-memory catalog first, so hot read
+# paths validate without touching the filesystem. Only names the catalog does
+# not know fall back to a stat (files dropped into the tree from outside).
+# Handles are bound to the images root of the current library unless a root
+# is given explicitly.
+
+
+def _stats_for(root: Path):
+    # the catalog indexing `root`, if it is the current library's
+    lib = current()
+    return lib.stats if lib.images_root == root else None
+
+
+@lru_cache(maxsize=4096)
+def clean_folder(name):
+    # normalized "a/b" folder path, or None for empty or unsafe names
+    # (traversal, hidden entries such as .trash, NUL bytes)
+    if not name:
+        return None
+    s = str(name).replace('\\', '/').strip()
+    parts = [p for p in s.split('/') if p and p != '.']
+    if not parts or any(p == '..' or p.startswith('.') or '\0' in p for p in parts):
+        return None
+    return '/'.join(parts)
+
+
+@lru_cache(maxsize=4096)
+def clean_filename(name):
+    # a single path component, or None
+    if not name:
+        return None
+    s = str(name).strip()
+    if not s or '/' in s or '\\' in s or '\0' in s or s.startswith('.'):
+        return None
+    return s
+
+
+class FolderRef(NamedTuple):
+    folder: str  # '' for the images root
+    root: Path
+
+    @property
+    def path(self) -> Path:
+        return self.root / self.folder if self.folder else self.root
+
+    @property
+    def url(self) -> str:
+        return f"/gallery?folder={self.folder}" if self.folder else "/gallery"
+
+    def exists(self) -> bool:
+        stats = _stats_for(self.root)
+        return (stats is not None and stats.has_folder(self.folder)) or self.path.is_dir()
+
+    def image(self, filename):
+        return image_ref(self.folder, filename, root=self.root)
+
+
+class ImageRef(NamedTuple):
+    folder: str
+    name: str
+    root: Path
+
+    @property
+    def rel(self) -> str:
+        return f"{self.folder}/{self.name}" if self.folder else self.name
+
+    @property
+    def path(self) -> Path:
+        return self.root / self.rel
+
+    @property
+    def url(self) -> str:
+        return f"/images/{self.rel}"
+
+    def exists(self) -> bool:
+        stats = _stats_for(self.root)
+        return (stats is not None and stats.record(self.rel) is not None) or self.path.is_file()
+
+    def with_name(self, filename):
+        return image_ref(self.folder, filename, root=self.root)
+
+
+def folder_ref(folder=None, root: Path = None):
+    # FolderRef for `folder` (the root when empty), None if the name is unsafe
+    if root is None:
+        root = current().images_root
+    if folder is None or not str(folder).strip().strip('/\\'):
+        return FolderRef('', root)
+    f = clean_folder(folder)
+    return FolderRef(f, root) if f else None
+
+
+def image_ref(folder, filename, root: Path = None):
+    # ImageRef for `filename` inside `folder`, None if either name is unsafe
+    # or names the root tags.json metadata file
+    fref = folder_ref(folder, root)
+    name = clean_filename(filename)
+    if fref is None or name is None or (not fref.folder and name == 'tags.json'):
+        return None
+    return ImageRef(fref.folder, name, fref.root)
+
+
+def image_ref_from_rel(rel, root: Path = None):
+    # ImageRef for a root-relative "a/b/name.jpg" path
+    if not rel:
+        return None
+    s = str(rel).replace('\\', '/').strip().strip('/')
+    folder, _, name = s.rpartition('/')
+    return image_ref(folder or None, name, root)
@@ -1,6 +1,5 @@
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse, HTMLResponse
-from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from typing import Optional, Any
 import os
@@ -8,7 +7,17 @@ import re
 import json
 import shutil
 from pathlib import Path
-from app.config import OPENAI_API_KEY, BASE_DIR as PROJECT_ROOT
+from app.config import OPENAI_API_KEY
+from app import catalog
+from app import phash
+from app import locks
+from app.resolver import clean_folder, folder_ref, image_ref
+from app.templating import templates
+from app.actions import Action, ActionError, action_dict, extract_json, parse_action
+from app import plans
+from app import tagfile
+from app.folder_stats import tags_of
+from app.libraries import current
 import uuid
 import datetime
 
@@ -21,62 +30,130 @@ except Exception:
     _OPENAI_AVAILABLE = False
 
 router = APIRouter()
-BASE_DIR = Path(__file__).resolve().parent.parent
-templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 
-# images root
-IMAGES_ROOT = Path(os.getenv('DATA_DIR', PROJECT_ROOT / 'data')) / 'images'
-IMAGES_ROOT.mkdir(parents=True, exist_ok=True)
-LOG_FILE = IMAGES_ROOT / '.ai_action_log.jsonl'
-TRASH_DIR = IMAGES_ROOT / '.trash'
-TRASH_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def _root():
+    # images root of the current request's library
+    return current().images_root
 
 
 class ChatRequest(BaseModel):
     message: Optional[str] = ""
     confirm: Optional[bool] = False
     action: Optional[Any] = None
+    plan_id: Optional[str] = None
 
 
-def summarize_action(action: dict):
-    # Non-destructive preview of what the action would do
-    intent = action.get('intent')
+def _folder_moves(sf: str, tf: str):
+    # [src, dst] for every file directly inside `sf`
+    try:
+        names = sorted(p.name for p in (_root() / sf).iterdir() if p.is_file())
+    except OSError:
+        return []
+    return [[f"{sf}/{n}", f"{tf}/{n}"] for n in names]
+
+
+def _query_moves(query: str, tref):
+    # [src, dst] for every query match; hidden files are never moved
+    items = []
+    for rel in find_images_by_query(query):
+        dst = tref.image(Path(rel).name)
+        if dst is not None:
+            items.append([rel, dst.rel])
+    return items
+
+
+def preview_action(action: Action):
+    # Non-destructive preview of what the action would do, plus the resolved
+    # [src, dst] file list execution will run on (dst None for deletes and
+    # tags; items None when the action has no precomputed file list)
+    intent = action.intent
     # folder move preview
-    src_folder = action.get('source_folder') or action.get('source')
-    target = action.get('target_folder') or action.get('target')
-    if src_folder and target:
-        sf = _sanitize_folder_name(src_folder)
-        if not sf:
-            return {"ok": False, "message": "invalid source folder"}
-        src_dir = IMAGES_ROOT / sf
-        if not src_dir.exists() or not src_dir.is_dir():
-            return {"ok": False, "message": f"source folder not found: {sf}"}
-        count = sum(1 for _ in src_dir.iterdir() if _.is_file())
-        return {"ok": True, "preview": {"move_count": count, "source": f"/{sf}", "target": f"/{_sanitize_folder_name(target)}"}}
-
-    if intent == 'move_image' or intent == 'move':
-        query = action.get('query', '')
-        matches = find_images_by_query(query)
-        return {"ok": True, "preview": {"move_count": len(matches), "sample": matches[:10]}}
-
-    if intent in ('delete_folder', 'remove_folder', 'rmdir'):
-        folder = action.get('folder') or action.get('source_folder')
-        sf = _sanitize_folder_name(folder)
+    if intent == 'move_folder':
+        sf = clean_folder(action.source_folder)
+        tf = clean_folder(action.target_folder)
+        if not sf or not tf:
+            return {"ok": False, "message": "invalid folder name"}, None
+        if not (_root() / sf).is_dir():
+            return {"ok": False, "message": f"source folder not found: {sf}"}, None
+        items = _folder_moves(sf, tf)
+        return {"ok": True, "preview": {"move_count": len(items), "source": f"/{sf}", "target": f"/{tf}"}}, items
+
+    if intent == 'move_image':
+        tref = folder_ref(action.target_folder)
+        if tref is None:
+            return {"ok": False, "message": "invalid target_folder"}, None
+        items = _query_moves(action.query, tref)
+        return {"ok": True, "preview": {"move_count": len(items), "sample": [src for src, _dst in items[:10]]}}, items
+
+    if intent == 'rename_image':
+        src_ref = image_ref(action.folder, action.old_name)
+        dst_ref = image_ref(action.folder, action.new_name)
+        if src_ref is None or dst_ref is None:
+            return {"ok": False, "message": "invalid names"}, None
+        return {"ok": True, "preview": {"from": src_ref.rel, "to": dst_ref.rel}}, None
+
+    if intent == 'delete_folder':
+        sf = clean_folder(action.folder)
         if not sf:
-            return {"ok": False, "message": "invalid folder"}
-        target_dir = IMAGES_ROOT / sf
-        if not target_dir.exists():
-            return {"ok": False, "message": "folder not found"}
-        count = sum(1 for _ in target_dir.rglob('*') if _.is_file())
-        return {"ok": True, "preview": {"deleted_files": count, "folder": f"/{sf}"}}
-
-    # default: for rename/delete by query, show matches
-    if intent in ('delete_image', 'delete', 'rename_image', 'rename'):
-        query = action.get('query', '')
-        if query:
-            matches = find_images_by_query(query)
-            return {"ok": True, "preview": {"matched": len(matches), "sample": matches[:10]}}
-    return {"ok": True, "preview": {}}
+            return {"ok": False, "message": "invalid folder"}, None
+        stats = current().stats.get(sf)
+        if stats is None:
+            return {"ok": False, "message": "folder not found"}, None
+        return {"ok": True, "preview": {"deleted_files": stats["files"], "folder": f"/{sf}"}}, None
+
+    if intent in ('find_duplicates', 'delete_duplicates'):
+        found = _find_duplicates(action)
+        if found is None:
+            return {"ok": False, "message": "similarity search unavailable (install Pillow and numpy)"}, None
+        if 'groups' in found:
+            victims = _duplicate_victims(found["groups"])
+            items = [[rel, None] for rel in victims] if intent == 'delete_duplicates' else None
+            return {"ok": True, "preview": {"groups": len(found["groups"]), "deleted_files": len(victims), "sample": found["groups"][:10]}}, items
+        return {"ok": True, "preview": {"file": found["file"], "matched": len(found["similar"]), "sample": found["similar"][:10]}}, None
+
+    # delete or tag by query: show matches
+    if intent == 'delete_image' or (intent == 'tag' and not action.filename):
+        matches = find_images_by_query(action.query)
+        return {"ok": True, "preview": {"matched": len(matches), "sample": matches[:10]}}, [[rel, None] for rel in matches]
+    return {"ok": True, "preview": {}}, None
+
+
+def _still_there(rel: str) -> bool:
+    # catalog first; a stat only for files it does not know (hidden or external)
+    return current().stats.record(rel) is not None or (_root() / rel).is_file()
+
+
+def _still_free(rel) -> bool:
+    # nothing appeared at a planned destination
+    return rel is None or not (_root() / rel).exists()
+
+
+def _touched(rel, changes) -> bool:
+    # whether `rel` or one of its folders is among the (files, folders) changed
+    if changes is None:
+        return True
+    files, folders = changes
+    if rel is None:
+        return False
+    if rel in files:
+        return True
+    parts = rel.split('/')
+    return any('/'.join(parts[:i]) in folders for i in range(1, len(parts) + 1))
+
+
+def revalidate_items(items, changes=None):
+    # drop planned files that disappeared since the preview and moves whose
+    # destination is taken now; (kept, dropped). With `changes` (see
+    # plans.changes) only the items they touch are checked again.
+    kept, dropped = [], []
+    for item in items:
+        if not (_touched(item[0], changes) or _touched(item[1], changes)):
+            kept.append(item)
+        else:
+            (kept if _still_there(item[0]) and _still_free(item[1]) else dropped).append(item)
+    return kept, dropped
 
 
 @router.get("/chat", response_class=HTMLResponse)
@@ -84,258 +161,375 @@ async def chat_ui(request: Request):
     return templates.TemplateResponse("chat.html", {"request": request})
 
 
-def extract_json(text: str):
-    # Try to extract the first JSON object or array from the text
-    if not text:
-        return None
-    # look for first { ... }
-    m = re.search(r"(\{.*\})", text, re.S)
-    if not m:
-        m = re.search(r"(\[.*\])", text, re.S)
-    if not m:
-        return None
-    s = m.group(1)
-    try:
-        return json.loads(s)
-    except Exception:
-        # try to fix common issues: single quotes -> double quotes
-        try:
-            fixed = s.replace("'", '"')
-            return json.loads(fixed)
-        except Exception:
-            return None
-
-
 def find_images_by_query(query: str):
-    # naive search: split query into tokens and match filenames containing all tokens
-    tokens = [t.lower() for t in re.findall(r"\w+", query)]
+    # naive search: split query into tokens and match filenames containing all tokens.
+    # Walks the catalog, which never lists hidden entries (.trash, the action
+    # log) or tags.json, so queries cannot pick those up.
+    tokens = [t.lower() for t in re.findall(r"\w+", query or '')]
+    if not tokens:
+        return []
     matches = []
-    for p in IMAGES_ROOT.rglob('*'):
-        if p.is_file():
-            name = p.name.lower()
-            if all(tok in name for tok in tokens):
-                # return path relative to IMAGES_ROOT
-                rel = p.relative_to(IMAGES_ROOT)
-                matches.append(str(rel).replace('\\', '/'))
+    for rel in sorted(current().stats.iter_files()):
+        name = rel.rpartition('/')[2].lower()
+        if all(tok in name for tok in tokens):
+            matches.append(rel)
     return matches
 
 
-def _sanitize_folder_name(name: str):
-    if not name:
-        return None
-    s = str(name).replace('\\', '/').strip()
-    # disallow traversal
-    parts = [p for p in s.split('/') if p and p != '.']
-    if any(p == '..' for p in parts):
-        return None
-    return '/'.join(parts)
+def _log(entry: dict):
+    # append one line to the action log; the lock keeps lines from interleaving across workers
+    entry.setdefault('ts', datetime.datetime.utcnow().isoformat() + 'Z')
+    try:
+        with locks.locked(meta=[locks.ACTION_LOG]):
+            with current().log_file.open('a', encoding='utf8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    except Exception:
+        pass
 
 
-def perform_action(action: dict):
-    # action is expected to have keys: intent, query, target_folder, filename, tags, etc.
-    intent = action.get('intent')
-    result = {"ok": False, "message": "unknown action"}
-    # helper to append action log
-    def _log(entry: dict):
-        entry.setdefault('ts', datetime.datetime.utcnow().isoformat() + 'Z')
-        try:
-            with LOG_FILE.open('a', encoding='utf8') as f:
-                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
-        except Exception:
-            pass
-    # If action defines a source_folder and target_folder, move all files from source -> target
-    src_folder = action.get('source_folder') or action.get('source')
-    target = action.get('target_folder') or action.get('target')
-    if src_folder and target:
-        sf = _sanitize_folder_name(src_folder)
-        tf = _sanitize_folder_name(target)
-        if not sf or not tf:
-            return {"ok": False, "message": "invalid folder name"}
-        src_dir = IMAGES_ROOT / sf
-        if not src_dir.exists() or not src_dir.is_dir():
-            return {"ok": False, "message": f"source folder not found: {sf}"}
-        dst_dir = IMAGES_ROOT / tf
-        dst_dir.mkdir(parents=True, exist_ok=True)
-        moved = 0
-        moved_items = []
-        for p in src_dir.iterdir():
-            if p.is_file():
-                try:
-                    dstp = dst_dir / p.name
-                    shutil.move(str(p), str(dstp))
-                    moved += 1
-                    moved_items.append({"src": str(p.relative_to(IMAGES_ROOT)), "dst": str(dstp.relative_to(IMAGES_ROOT))})
-                except Exception:
-                    pass
-        res = {"ok": True, "moved": moved, "target": f"/{tf}", "source": f"/{sf}", "items": moved_items}
-        _log({"id": str(uuid.uuid4()), "action": action, "result": res, "inverse": {"type": "move", "items": [{"src": i["dst"], "dst": i["src"]} for i in moved_items]}})
-        return res
+def _parent_folders(rels):
+    # folders (relative to the images root) holding the given relative file paths
+    folders = set()
+    for rel in rels:
+        parent = str(Path(rel).parent).replace('\\', '/')
+        folders.add('' if parent == '.' else parent)
+    return folders
 
-    if intent == 'move_image' or intent == 'move':
-        query = action.get('query', '')
-        target = action.get('target_folder')
-        if not target:
-            return {"ok": False, "message": "missing target_folder"}
-        matches = find_images_by_query(query)
-        moved = 0
-        moved_items = []
+
+def _delete_to_trash(action: Action, matches):
+    # move the given files (relative to the images root) into a fresh trash bucket so undo can restore them;
+    # each keeps its relative path inside the bucket, so same-named files from different folders never collide
+    deleted = 0
+    moved_to_trash = []
+    trash_bucket = current().trash_dir / (datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S') + '_' + str(uuid.uuid4()))
+    trash_bucket.mkdir(parents=True, exist_ok=True)
+    with locks.locked(files_in=_parent_folders(matches)):
         for rel in matches:
-            src = IMAGES_ROOT / rel
-            dst_dir = IMAGES_ROOT / target.strip('/').lstrip('/')
-            dst_dir.mkdir(parents=True, exist_ok=True)
-            dst = dst_dir / src.name
+            p = _root() / rel
             try:
-                shutil.move(str(src), str(dst))
-                moved += 1
-                moved_items.append({"src": str(src.relative_to(IMAGES_ROOT)), "dst": str(dst.relative_to(IMAGES_ROOT))})
+                dst = trash_bucket / rel
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(p), str(dst))
+                catalog.remove_file(p)
+                deleted += 1
+                moved_to_trash.append({"src": str(rel), "trash": str(dst.relative_to(_root()))})
             except Exception:
                 pass
-        res = {"ok": True, "moved": moved, "target": target, "items": moved_items}
-        _log({"id": str(uuid.uuid4()), "action": action, "result": res, "inverse": {"type": "move", "items": [{"src": i["dst"], "dst": i["src"]} for i in moved_items]}})
+        res = {"ok": True, "deleted": deleted, "trash_bucket": str(trash_bucket.relative_to(_root())), "items": moved_to_trash}
+        _log({"id": str(uuid.uuid4()), "action": action_dict(action), "result": res, "inverse": {"type": "restore_trash", "bucket": str(trash_bucket.relative_to(_root())), "items": moved_to_trash}})
         return res
 
-    if intent == 'rename_image' or intent == 'rename':
-        folder = action.get('folder')
-        old = action.get('old_name') or action.get('filename')
-        new = action.get('new_name')
-        if not old or not new:
-            return {"ok": False, "message": "missing names"}
-        src = IMAGES_ROOT / old if not folder else IMAGES_ROOT / folder.strip('/') / old
-        dst = IMAGES_ROOT / new if not folder else IMAGES_ROOT / folder.strip('/') / new
+
+def _find_duplicates(action: Action):
+    # {"groups": [...]} of near-identical images (optionally within a folder), or
+    # {"similar": [...]} for one image when a filename is given; None if hashing is unavailable
+    if not phash.available():
+        return None
+    fref = folder_ref(action.folder)
+    if fref is None:
+        return {"groups": []}
+    filename = action.filename
+    kwargs = {}
+    if action.max_distance is not None:
+        kwargs["max_distance"] = action.max_distance
+    if filename:
+        ref = fref.image(filename)
+        if ref is None:
+            return {"file": filename, "similar": []}
+        return {"file": ref.rel, "similar": current().phash.similar(ref.rel, **kwargs) or []}
+    return {"groups": current().phash.duplicates(fref.folder or None, **kwargs) or []}
+
+
+def _file_size(rel):
+    try:
+        return (_root() / rel).stat().st_size
+    except OSError:
+        return -1
+
+
+def _duplicate_victims(groups):
+    # keep the largest file of every group (ties: first by name), trash the rest
+    victims = []
+    for group in groups:
+        ranked = sorted(group, key=lambda rel: (-_file_size(rel), rel))
+        victims.extend(ranked[1:])
+    return victims
+
+
+def _move_items(items):
+    # move planned [src, dst] pairs; files that vanished meanwhile are skipped
+    # and an existing destination is never overwritten
+    moved_items = []
+    for src_rel, dst_rel in items:
+        src, dst = _root() / src_rel, _root() / dst_rel
+        if dst.exists():
+            continue
         try:
-            src.rename(dst)
-            res = {"ok": True, "new_name": str(dst.relative_to(IMAGES_ROOT))}
-            _log({"id": str(uuid.uuid4()), "action": action, "result": res, "inverse": {"type": "rename", "old": str(dst.relative_to(IMAGES_ROOT)), "new": str(src.relative_to(IMAGES_ROOT))}})
+            shutil.move(str(src), str(dst))
+            catalog.move_file(src, dst)
+            moved_items.append({"src": src_rel, "dst": dst_rel})
+        except Exception:
+            pass
+    tagfile.follow_moves((i["src"], i["dst"]) for i in moved_items)
+    return moved_items
+
+
+def perform_action(action: Action, items=None):
+    # action is a validated model from app.actions (see parse_action); `items`
+    # is the file list from preview_action, recomputed here when not given
+    intent = action.intent
+    result = {"ok": False, "message": "unknown action"}
+    # move all files from source_folder -> target_folder
+    if intent == 'move_folder':
+        sf = clean_folder(action.source_folder)
+        tf = clean_folder(action.target_folder)
+        if not sf or not tf:
+            return {"ok": False, "message": "invalid folder name"}
+        with locks.locked(files_in=[sf, tf]):
+            src_dir = _root() / sf
+            if not src_dir.exists() or not src_dir.is_dir():
+                return {"ok": False, "message": f"source folder not found: {sf}"}
+            if items is None:
+                items = _folder_moves(sf, tf)
+            (_root() / tf).mkdir(parents=True, exist_ok=True)
+            moved_items = _move_items(items)
+            res = {"ok": True, "moved": len(moved_items), "target": f"/{tf}", "source": f"/{sf}", "items": moved_items}
+            _log({"id": str(uuid.uuid4()), "action": action_dict(action), "result": res, "inverse": {"type": "move", "items": [{"src": i["dst"], "dst": i["src"]} for i in moved_items]}})
             return res
-        except Exception as e:
-            return {"ok": False, "message": str(e)}
 
-    if intent == 'delete_image' or intent == 'delete':
-        query = action.get('query', '')
-        matches = find_images_by_query(query)
-        deleted = 0
-        moved_to_trash = []
-        trash_bucket = TRASH_DIR / (datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S') + '_' + str(uuid.uuid4()))
-        trash_bucket.mkdir(parents=True, exist_ok=True)
-        for rel in matches:
-            p = IMAGES_ROOT / rel
-            try:
-                dst = trash_bucket / p.name
-                shutil.move(str(p), str(dst))
-                deleted += 1
-                moved_to_trash.append({"src": str(rel), "trash": str(dst.relative_to(IMAGES_ROOT))})
-            except Exception:
-                pass
-        res = {"ok": True, "deleted": deleted, "trash_bucket": str(trash_bucket.relative_to(IMAGES_ROOT)), "items": moved_to_trash}
-        _log({"id": str(uuid.uuid4()), "action": action, "result": res, "inverse": {"type": "restore_trash", "bucket": str(trash_bucket.relative_to(IMAGES_ROOT)), "items": moved_to_trash}})
-        return res
+    if intent == 'move_image':
+        query = action.query
+        target = action.target_folder
+        tref = folder_ref(target)
+        if tref is None:
+            return {"ok": False, "message": "invalid target_folder"}
+        if items is None:
+            items = _query_moves(query, tref)
+        scope = _parent_folders(src for src, _dst in items) | {tref.folder}
+        with locks.locked(files_in=scope):
+            if items:
+                tref.path.mkdir(parents=True, exist_ok=True)
+            moved_items = _move_items(items)
+            res = {"ok": True, "moved": len(moved_items), "target": target, "items": moved_items}
+            _log({"id": str(uuid.uuid4()), "action": action_dict(action), "result": res, "inverse": {"type": "move", "items": [{"src": i["dst"], "dst": i["src"]} for i in moved_items]}})
+            return res
 
-    if intent == 'tag' or intent == 'tag_image':
-        # store tags in a tags.json in IMAGES_ROOT; support tagging by filename or by query
-        tags_file = IMAGES_ROOT / 'tags.json'
-        data = {}
-        if tags_file.exists():
+    if intent == 'rename_image':
+        src_ref = image_ref(action.folder, action.old_name)
+        dst_ref = image_ref(action.folder, action.new_name)
+        if src_ref is None or dst_ref is None:
+            return {"ok": False, "message": "invalid names"}
+        src, dst = src_ref.path, dst_ref.path
+        with locks.locked(files_in=[src_ref.folder]):
+            if not src_ref.exists():
+                return {"ok": False, "message": f"file not found: {src_ref.rel}"}
+            if dst_ref.exists():
+                return {"ok": False, "message": f"destination exists: {dst_ref.rel}"}
             try:
-                data = json.loads(tags_file.read_text())
-            except Exception:
-                data = {}
-        tags = action.get('tags') or action.get('labels') or []
-        # target by explicit filename
-        filename = action.get('filename') or action.get('file') or action.get('image')
-        folder = action.get('folder')
-        matched = []
-        if filename:
-            key = f"{folder}/{filename}" if folder else filename
-            # normalize key if file exists under images root
-            p = IMAGES_ROOT / key
-            if not p.exists():
-                # try to find file by name anywhere
-                found = None
-                for q in IMAGES_ROOT.rglob(filename):
-                    if q.is_file():
-                        found = q
-                        break
-                if found:
-                    key = str(found.relative_to(IMAGES_ROOT)).replace('\\', '/')
-            # ensure entry is object
-            entry = data.get(key)
-            if not isinstance(entry, dict):
-                entry_tags = entry if isinstance(entry, list) else []
-                data[key] = {"tags": entry_tags, "uploaded_at": None}
-            for t in tags:
-                if t not in data[key].setdefault('tags', []):
-                    data[key]['tags'].append(t)
-            matched = [key]
-        else:
-            # tag by query
-            query = action.get('query', '')
-            matches = find_images_by_query(query)
-            for rel in matches:
-                entry = data.get(rel)
+                src.rename(dst)
+                catalog.move_file(src, dst)
+                tagfile.follow_moves([(src_ref.rel, dst_ref.rel)])
+                res = {"ok": True, "new_name": str(dst.relative_to(_root()))}
+                _log({"id": str(uuid.uuid4()), "action": action_dict(action), "result": res, "inverse": {"type": "rename", "old": str(dst.relative_to(_root())), "new": str(src.relative_to(_root()))}})
+                return res
+            except Exception as e:
+                return {"ok": False, "message": str(e)}
+
+    if intent == 'delete_image':
+        matches = [src for src, _dst in items] if items is not None else find_images_by_query(action.query)
+        return _delete_to_trash(action, matches)
+
+    if intent == 'find_duplicates':
+        found = _find_duplicates(action)
+        if found is None:
+            return {"ok": False, "message": "similarity search unavailable (install Pillow and numpy)"}
+        if 'groups' in found:
+            found["duplicate_files"] = sum(len(g) - 1 for g in found["groups"])
+        return {"ok": True, **found}
+
+    if intent == 'delete_duplicates':
+        if items is not None:
+            return _delete_to_trash(action, [src for src, _dst in items])
+        found = _find_duplicates(action)
+        if found is None or 'groups' not in found:
+            return {"ok": False, "message": "similarity search unavailable (install Pillow and numpy)"}
+        return _delete_to_trash(action, _duplicate_victims(found["groups"]))
+
+    if intent == 'tag':
+        # store tags in a tags.json in the images root; support tagging by filename or by query
+        with locks.locked(meta=[locks.TAGS]):
+            tags_file = _root() / 'tags.json'
+            data = {}
+            if tags_file.exists():
+                try:
+                    data = json.loads(tags_file.read_text())
+                except Exception:
+                    data = {}
+            tags = action.tags
+            # target by explicit filename
+            filename = action.filename
+            folder = action.folder
+            matched = []
+            ref = image_ref(folder, filename) if filename else None
+            if filename and ref is None:
+                return {"ok": False, "message": "invalid filename"}
+            if filename:
+                key = ref.rel
+                # normalize key if file exists under images root
+                if not ref.exists():
+                    # try to find file by name anywhere
+                    found = None
+                    for q in _root().rglob(filename):
+                        if q.is_file():
+                            found = q
+                            break
+                    if found:
+                        key = str(found.relative_to(_root())).replace('\\', '/')
+                # ensure entry is object
+                entry = data.get(key)
                 if not isinstance(entry, dict):
                     entry_tags = entry if isinstance(entry, list) else []
-                    data[rel] = {"tags": entry_tags, "uploaded_at": None}
+                    data[key] = {"tags": entry_tags, "uploaded_at": None}
                 for t in tags:
-                    if t not in data[rel].setdefault('tags', []):
-                        data[rel]['tags'].append(t)
-            matched = matches
-        try:
-            tags_file.write_text(json.dumps(data, indent=2, ensure_ascii=False))
-        except Exception:
-            pass
-        # build result including upload timestamps if available
-        details = []
-        for k in matched:
-            entry = data.get(k, {})
-            details.append({"file": k, "tags": entry.get('tags', []), "uploaded_at": entry.get('uploaded_at')})
-        res = {"ok": True, "tagged": len(matched), "details": details}
-        _log({"id": str(uuid.uuid4()), "action": action, "result": res, "inverse": {"type": "tags", "items": matched}})
-        return res
+                    if t not in data[key].setdefault('tags', []):
+                        data[key]['tags'].append(t)
+                matched = [key]
+            else:
+                # tag by query
+                matches = [src for src, _dst in items] if items is not None else find_images_by_query(action.query)
+                for rel in matches:
+                    entry = data.get(rel)
+                    if not isinstance(entry, dict):
+                        entry_tags = entry if isinstance(entry, list) else []
+                        data[rel] = {"tags": entry_tags, "uploaded_at": None}
+                    for t in tags:
+                        if t not in data[rel].setdefault('tags', []):
+                            data[rel]['tags'].append(t)
+                matched = matches
+            try:
+                tags_file.write_text(json.dumps(data, indent=2, ensure_ascii=False))
+            except Exception:
+                pass
+            for k in matched:
+                catalog.set_tags(k, data.get(k, {}).get('tags', []))
+            # build result including upload timestamps if available
+            details = []
+            for k in matched:
+                entry = data.get(k, {})
+                details.append({"file": k, "tags": entry.get('tags', []), "uploaded_at": entry.get('uploaded_at')})
+            res = {"ok": True, "tagged": len(matched), "details": details}
+            _log({"id": str(uuid.uuid4()), "action": action_dict(action), "result": res, "inverse": {"type": "tags", "items": matched}})
+            return res
 
-    if intent == 'summarize' or intent == 'summary':
-        query = action.get('query', '')
+    if intent == 'summarize':
+        query = action.query
+        folder = action.folder
+        if folder or not query:
+            # folder-level summaries come straight from the aggregate index
+            fref = folder_ref(folder)
+            if fref is None:
+                return {"ok": False, "message": "invalid folder"}
+            sf = fref.folder
+            stats = current().stats.get(sf)
+            if stats is None:
+                return {"ok": False, "message": f"folder not found: {sf}"}
+            return {"ok": True, "folder": f"/{sf}", "count": stats["files"], "bytes": stats["bytes"], "newest_upload": stats["newest_upload"], "tags": stats["tags"]}
         matches = find_images_by_query(query)
         return {"ok": True, "count": len(matches), "samples": matches[:10]}
 
     # delete/remove folder
-    if intent in ('delete_folder', 'remove_folder', 'rmdir'):
-        folder = action.get('folder') or action.get('source_folder') or action.get('target_folder')
-        if not folder:
-            return {"ok": False, "message": "missing folder"}
-        sf = _sanitize_folder_name(folder)
+    if intent == 'delete_folder':
+        sf = clean_folder(action.folder)
         if not sf:
             return {"ok": False, "message": "invalid folder name"}
-        target_dir = IMAGES_ROOT / sf
-        if not target_dir.exists() or not target_dir.is_dir():
-            return {"ok": False, "message": f"folder not found: {sf}"}
-        recursive = bool(action.get('recursive', False))
-        if recursive:
-            # move folder into trash for possible restore
-            trash_bucket = TRASH_DIR / (datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S') + '_' + str(uuid.uuid4()))
-            try:
-                shutil.move(str(target_dir), str(trash_bucket))
-                count = sum(1 for _ in trash_bucket.rglob('*') if _.is_file())
-                res = {"ok": True, "deleted_files": count, "folder": f"/{sf}", "trash_bucket": str(trash_bucket.relative_to(IMAGES_ROOT))}
-                _log({"id": str(uuid.uuid4()), "action": action, "result": res, "inverse": {"type": "restore_trash_folder", "bucket": str(trash_bucket.relative_to(IMAGES_ROOT))}})
-                return res
-            except Exception as e:
-                return {"ok": False, "message": str(e)}
-        else:
-            try:
-                target_dir.rmdir()
-                res = {"ok": True, "deleted_files": 0, "folder": f"/{sf}"}
-                _log({"id": str(uuid.uuid4()), "action": action, "result": res, "inverse": {"type": "remove_folder_empty", "folder": f"/{sf}"}})
-                return res
-            except Exception as e:
-                return {"ok": False, "message": "folder not empty or cannot remove: " + str(e)}
+        with locks.locked(trees=[sf]):
+            target_dir = _root() / sf
+            if not target_dir.exists() or not target_dir.is_dir():
+                return {"ok": False, "message": f"folder not found: {sf}"}
+            if action.recursive:
+                # move folder into trash for possible restore
+                trash_bucket = current().trash_dir / (datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S') + '_' + str(uuid.uuid4()))
+                try:
+                    stats = current().stats.get(sf)
+                    shutil.move(str(target_dir), str(trash_bucket))
+                    catalog.remove_tree(sf)
+                    count = stats["files"] if stats else 0
+                    res = {"ok": True, "deleted_files": count, "folder": f"/{sf}", "trash_bucket": str(trash_bucket.relative_to(_root()))}
+                    _log({"id": str(uuid.uuid4()), "action": action_dict(action), "result": res, "inverse": {"type": "restore_trash_folder", "bucket": str(trash_bucket.relative_to(_root()))}})
+                    return res
+                except Exception as e:
+                    return {"ok": False, "message": str(e)}
+            else:
+                try:
+                    target_dir.rmdir()
+                    catalog.remove_tree(sf)
+                    res = {"ok": True, "deleted_files": 0, "folder": f"/{sf}"}
+                    _log({"id": str(uuid.uuid4()), "action": action_dict(action), "result": res, "inverse": {"type": "remove_folder_empty", "folder": f"/{sf}"}})
+                    return res
+                except Exception as e:
+                    return {"ok": False, "message": "folder not empty or cannot remove: " + str(e)}
 
     return result
 
 
 
+def _run_plan(plan_id):
+    # (result, action dict) for a stored plan; when the library changed in
+    # between, the items those changes touched are checked again
+    plan = plans.take(plan_id)
+    if plan is None:
+        return {"ok": False, "message": "preview expired or already executed; please ask again"}, None
+    action = parse_action(plan["action"])
+    items = plan["items"]
+    dropped = []
+    if items is not None and not plans.is_current(plan):
+        items, dropped = revalidate_items(items, plans.changes(plan))
+    executed = perform_action(action, items)
+    if dropped:
+        executed["skipped"] = [src for src, _dst in dropped]
+    return executed, plan["action"]
+
+
+def _preview_reply(action: Action, reply: str):
+    # preview (do NOT execute); the resolved file list is kept server-side so
+    # confirming the returned plan_id runs exactly what was previewed
+    position = plans.position()
+    preview, items = preview_action(action)
+    plan = plans.create(action_dict(action), items, preview, position) if preview.get('ok') else None
+    return JSONResponse({"reply": reply, "raw_action": action_dict(action), "preview": preview, "plan_id": plan["id"] if plan else None, "requires_confirmation": True})
+
+
+def _confirm(req: ChatRequest):
+    if not req.plan_id:
+        # older clients send the whole action back; it was never previewed as
+        # such, so preview it now and let the user confirm that plan
+        try:
+            action = parse_action(req.action)
+        except ActionError as e:
+            return JSONResponse({"reply": f"❌ Action failed: invalid action: {e}", "action_result": {"ok": False, "message": f"invalid action: {e}"}, "raw_action": req.action})
+        return _preview_reply(action, "Preview generated. Confirm to execute.")
+    executed, raw_action = _run_plan(req.plan_id)
+    # build human message
+    if executed.get('ok'):
+        human = None
+        if executed.get('source') and executed.get('target'):
+            human = f"✅ Moved {executed.get('moved',0)} images from {executed.get('source')} to {executed.get('target')}"
+        elif executed.get('folder') and 'deleted_files' in executed:
+            df = executed.get('deleted_files', 0)
+            human = f"✅ Removed folder {executed.get('folder')} (deleted {df} files)" if df else f"✅ Removed empty folder {executed.get('folder')}"
+        else:
+            human = f"✅ Action executed"
+    else:
+        human = f"❌ Action failed: {executed.get('message') or executed}"
+    return JSONResponse({"reply": human, "action_result": executed, "raw_action": raw_action})
+
+
 @router.post("/agent/chat")
-async def chat_endpoint(req: ChatRequest):
+def chat_endpoint(req: ChatRequest):
     user_msg = req.message
+    # confirming a preview executes the stored plan; no completion is needed
+    if req.confirm and (req.plan_id or req.action):
+        return _confirm(req)
     # Only attempt real OpenAI call when client is available and key provided
     if OPENAI_API_KEY and _OPENAI_AVAILABLE:
         model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
@@ -349,7 +543,8 @@ async def chat_endpoint(req: ChatRequest):
                 "{\"intent\": \"rename_image\", \"old_name\": \"IMG_0001.png\", \"new_name\": \"receipt_dec1.png\"}\n"
                 "{\"source_folder\": \"Japan/Raw\", \"target_folder\": \"Japan/Edited\"}\n"
                 "{\"intent\": \"delete_folder\", \"folder\": \"OldTrips/2018\", \"recursive\": true}\n"
-                "Allowed intents: move_image/move, rename_image/rename, tag/tag_image, delete_image/delete, summarize/summary. You may also specify \"source_folder\" and \"target_folder\" to move entire folders, or intent \"delete_folder\" to remove a folder."
+                "{\"intent\": \"delete_duplicates\", \"folder\": \"Japan\"}\n"
+                "Allowed intents: move_image/move, rename_image/rename, tag/tag_image, delete_image/delete, summarize/summary, find_duplicates (optionally with \"filename\" to find images similar to one file), delete_duplicates. You may also specify \"source_folder\" and \"target_folder\" to move entire folders, or intent \"delete_folder\" to remove a folder."
             )
             resp = client.chat.completions.create(
                 model=model,
@@ -358,6 +553,8 @@ async def chat_endpoint(req: ChatRequest):
                     {"role": "user", "content": user_msg},
                 ],
                 max_tokens=400,
+                # JSON mode: the reply is a single JSON object, no prose around it
+                response_format={"type": "json_object"},
             )
 
             # Normalize response
@@ -371,27 +568,12 @@ async def chat_endpoint(req: ChatRequest):
             if action_json is None:
                 return JSONResponse({"reply": content, "action_result": {"ok": False, "message": "No JSON action found"}})
 
-            # If client asked to confirm/execute (sent confirm + action), perform that
-            if req.confirm and req.action:
-                # execute provided action
-                executed = perform_action(req.action)
-                # build human message
-                if executed.get('ok'):
-                    human = None
-                    if executed.get('source') and executed.get('target'):
-                        human = f"✅ Moved {executed.get('moved',0)} images from {executed.get('source')} to {executed.get('target')}"
-                    elif executed.get('folder') and 'deleted_files' in executed:
-                        df = executed.get('deleted_files', 0)
-                        human = f"✅ Removed folder {executed.get('folder')} (deleted {df} files)" if df else f"✅ Removed empty folder {executed.get('folder')}"
-                    else:
-                        human = f"✅ Action executed"
-                else:
-                    human = f"❌ Action failed: {executed.get('message') or executed}"
-                return JSONResponse({"reply": human, "action_result": executed, "raw_action": req.action})
+            try:
+                action = parse_action(action_json)
+            except ActionError as e:
+                return JSONResponse({"reply": content, "action_result": {"ok": False, "message": f"invalid action: {e}"}})
 
-            # Otherwise, return a preview (do NOT execute)
-            preview = summarize_action(action_json)
-            return JSONResponse({"reply": "Preview generated. Confirm to execute.", "raw_action": action_json, "preview": preview, "requires_confirmation": True})
+            return _preview_reply(action, "Preview generated. Confirm to execute.")
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
@@ -403,12 +585,20 @@ async def chat_endpoint(req: ChatRequest):
 
 
 @router.post('/agent/undo')
-async def agent_undo():
+def agent_undo():
+    # undo is rare: hold the whole tree plus the action log so the read-pick-undo-append
+    # sequence cannot race another worker undoing the same entry (tags.json too,
+    # since restored files take their entries along)
+    with locks.locked(trees=[''], meta=[locks.TAGS, locks.ACTION_LOG]):
+        return _undo_last()
+
+
+def _undo_last():
     # read log lines
-    if not LOG_FILE.exists():
+    if not current().log_file.exists():
         return JSONResponse({"ok": False, "message": "no action log found"})
     try:
-        with LOG_FILE.open('r', encoding='utf8') as f:
+        with current().log_file.open('r', encoding='utf8') as f:
             lines = [json.loads(l) for l in f.read().splitlines() if l.strip()]
     except Exception as e:
         return JSONResponse({"ok": False, "message": f"failed to read log: {e}"})
@@ -432,50 +622,63 @@ async def agent_undo():
         itype = inv.get('type')
         if itype == 'move':
             restored = 0
+            moves = []
             for it in inv.get('items', []):
-                src = IMAGES_ROOT / it['src']
-                dst = IMAGES_ROOT / it['dst']
+                src = _root() / it['src']
+                dst = _root() / it['dst']
                 dst.parent.mkdir(parents=True, exist_ok=True)
                 if src.exists():
                     shutil.move(str(src), str(dst))
+                    catalog.move_file(src, dst)
+                    moves.append((it['src'], it['dst']))
                     restored += 1
+            tagfile.follow_moves(moves)
             undo_result = {"ok": True, "restored": restored}
 
         elif itype == 'rename':
             old = Path(inv.get('old'))
             new = Path(inv.get('new'))
-            src = IMAGES_ROOT / old
-            dst = IMAGES_ROOT / new
+            src = _root() / old
+            dst = _root() / new
             dst.parent.mkdir(parents=True, exist_ok=True)
             if src.exists():
                 shutil.move(str(src), str(dst))
-                undo_result = {"ok": True, "restored": str(dst.relative_to(IMAGES_ROOT))}
+                catalog.move_file(src, dst)
+                tagfile.follow_moves([(old.as_posix(), new.as_posix())])
+                undo_result = {"ok": True, "restored": str(dst.relative_to(_root()))}
             else:
                 undo_result = {"ok": False, "message": "file not found"}
 
         elif itype in ('restore_trash', 'restore_trash_folder'):
             bucket = inv.get('bucket')
-            bucket_path = IMAGES_ROOT / bucket
+            bucket_path = _root() / bucket
             restored = 0
             if bucket_path.exists():
-                # if items provided, restore individually
+                # if items provided, restore individually; their tags.json
+                # entries were kept, so the catalog gets their tags back too
+                data = tagfile.load(_root()) if inv.get('items') else {}
                 for it in inv.get('items', []):
-                    trashp = IMAGES_ROOT / it.get('trash')
-                    orig = IMAGES_ROOT / it.get('src')
+                    trashp = _root() / it.get('trash')
+                    orig = _root() / it.get('src')
                     orig.parent.mkdir(parents=True, exist_ok=True)
                     if trashp.exists():
                         shutil.move(str(trashp), str(orig))
+                        catalog.add_file(orig)
+                        tags = tags_of(data.get(it.get('src')))
+                        if tags:
+                            catalog.set_tags(orig, tags)
                         restored += 1
                 # if folder restore, move bucket to original location if possible
                 if itype == 'restore_trash_folder':
                     # attempt move bucket back to original folder name from candidate.action.folder
                     orig_folder = candidate.get('action', {}).get('folder')
                     if orig_folder:
-                        sf = _sanitize_folder_name(orig_folder)
+                        sf = clean_folder(orig_folder)
                         if sf:
-                            dest = IMAGES_ROOT / sf
+                            dest = _root() / sf
                             if not dest.exists():
                                 shutil.move(str(bucket_path), str(dest))
+                                catalog.add_tree(dest)
                                 undo_result = {"ok": True, "restored_folder": f"/{sf}"}
                             else:
                                 undo_result = {"ok": False, "message": "destination exists"}
@@ -484,10 +687,12 @@ async def agent_undo():
                     else:
                         undo_result = {"ok": False, "message": "no original folder info"}
                 else:
-                    # cleanup empty bucket
+                    # cleanup the emptied folders of the bucket, deepest first,
+                    # then the bucket itself
                     try:
-                        if bucket_path.exists() and not any(bucket_path.iterdir()):
-                            bucket_path.rmdir()
+                        for d in sorted((p for p in bucket_path.rglob('*') if p.is_dir()), key=lambda p: len(p.parts), reverse=True) + [bucket_path]:
+                            if not any(d.iterdir()):
+                                d.rmdir()
                     except Exception:
                         pass
                     undo_result = {"ok": True, "restored": restored}
@@ -502,7 +707,7 @@ async def agent_undo():
 
     # append undo log
     try:
-        with LOG_FILE.open('a', encoding='utf8') as f:
+        with current().log_file.open('a', encoding='utf8') as f:
             f.write(json.dumps({"id": str(uuid.uuid4()), "type": "undo", "undo_of": candidate.get('id'), "result": undo_result, "ts": datetime.datetime.utcnow().isoformat() + 'Z'}, ensure_ascii=False) + '\n')
     except Exception:
         pass
@@ -0,0 +1,362 @@
+from fastapi import APIRouter, Request, UploadFile, File, Form, HTTPException, Query
+from fastapi.responses import StreamingResponse, Response
+from collections import OrderedDict
+from pathlib import Path
+from array import array
+import bisect
+import datetime
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from app.folder_stats import relative_parts
+from app import catalog
+from app import locks
+from app.routes.agent import find_images_by_query
+from app.resolver import folder_ref
+from app.libraries import current
+
+router = APIRouter()
+
+CHUNK_SIZE = 64 * 1024
+_ZEROS = bytes(CHUNK_SIZE)
+LAYOUT_CACHE_SIZE = 8
+
+
+# -- export -----------------------------------------------------------------
+#
+# Archives are generated chunk by chunk straight from the image files; nothing
+# is staged on disk and memory stays at one chunk regardless of archive size.
+# Member sizes come from the folder statistics index, so the TAR layout (and
+# total length) is known before the first byte is sent; that is what makes
+# Range requests on TAR exports exact. The layout is kept per ETag, so a
+# resumed download only seeks into it. ZIP exports stream too, but are not
+# resumable.
+
+
+def _export_members(lib, folder: str, query: str):
+    # sorted (arcname, rel, size, mtime); arcnames are relative to the exported folder
+    if query:
+        records = []
+        for rel in find_images_by_query(query):
+            rec = lib.stats.record(rel)
+            if rec:
+                records.append((rel, rec[0], rec[1]))
+        base = ''
+    else:
+        records = lib.stats.iter_records(folder)
+        base = folder
+    records.sort()
+    return [(rel[len(base) + 1:] if base else rel, rel, size, mtime) for rel, size, mtime in records]
+
+
+def _etag(members):
+    h = hashlib.sha1()
+    for arcname, _rel, size, mtime in members:
+        h.update(f"{arcname}\0{size}\0{int(mtime)}\n".encode('utf8', 'surrogateescape'))
+    return '"' + h.hexdigest() + '"'
+
+
+def _tar_header(arcname, size, mtime):
+    info = tarfile.TarInfo(arcname)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+
+def _padded(size):
+    return (size + 511) // 512 * 512
+
+
+def _tar_layout(members):
+    # byte offset of every member plus the total archive length
+    offsets = array('q')
+    offset = 0
+    for arcname, _rel, size, mtime in members:
+        offsets.append(offset)
+        offset += len(_tar_header(arcname, size, mtime)) + _padded(size)
+    return offsets, offset + 1024  # two zero blocks end the archive
+
+
+_layouts = OrderedDict()  # etag -> (offsets, total), least recently used first
+_layouts_guard = threading.Lock()
+
+
+def _cached_layout(etag, members):
+    # the ETag covers every name, size and mtime, so it identifies the layout
+    with _layouts_guard:
+        layout = _layouts.get(etag)
+        if layout is not None:
+            _layouts.move_to_end(etag)
+            return layout
+    layout = _tar_layout(members)
+    with _layouts_guard:
+        _layouts[etag] = layout
+        while len(_layouts) > LAYOUT_CACHE_SIZE:
+            _layouts.popitem(last=False)
+    return layout
+
+
+def _window(seg_start, seg_len, start, end):
+    # (skip, take) of segment [seg_start, seg_start + seg_len) that lies in [start, end]
+    a = max(start, seg_start)
+    b = min(end + 1, seg_start + seg_len)
+    return (a - seg_start, b - a) if b > a else (0, 0)
+
+
+def _zeros(n):
+    while n > 0:
+        k = min(n, CHUNK_SIZE)
+        yield _ZEROS[:k]
+        n -= k
+
+
+def _read_file(path: Path, skip: int, take: int):
+    # `take` bytes of a file from `skip`; a file that shrank since it was
+    # listed is zero-padded so the archive stays well-formed
+    try:
+        with path.open('rb') as f:
+            f.seek(skip)
+            while take > 0:
+                chunk = f.read(min(CHUNK_SIZE, take))
+                if not chunk:
+                    break
+                take -= len(chunk)
+                yield chunk
+    except OSError:
+        pass
+    yield from _zeros(take)
+
+
+def _tar_stream(root: Path, members, offsets, total, start, end):
+    # generated outside the request context, so the images root is passed in
+    first = max(bisect.bisect_right(offsets, start) - 1, 0)
+    for i in range(first, len(members)):
+        off = offsets[i]
+        if off > end:
+            return
+        arcname, rel, size, mtime = members[i]
+        header = _tar_header(arcname, size, mtime)
+        skip, take = _window(off, len(header), start, end)
+        if take:
+            yield header[skip:skip + take]
+        off += len(header)
+        skip, take = _window(off, size, start, end)
+        if take:
+            yield from _read_file(root / rel, skip, take)
+        off += size
+        skip, take = _window(off, _padded(size) - size, start, end)
+        yield from _zeros(take)
+    _skip, take = _window(total - 1024, 1024, start, end)
+    yield from _zeros(take)
+
+
+class _Sink:
+    # unseekable write target; zipfile then emits data descriptors and the
+    # generator hands out whatever was written after every chunk
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, b):
+        self.buf += b
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        out = bytes(self.buf)
+        self.buf.clear()
+        return out
+
+
+def _zip_stream(root: Path, members):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for arcname, rel, size, mtime in members:
+            info = zipfile.ZipInfo(arcname, date_time=max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+            info.file_size = size
+            try:
+                src = (root / rel).open('rb')
+            except OSError:
+                continue
+            with src, zf.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+
+def _parse_range(header: str, total: int):
+    # single "bytes=a-b" range -> (start, end); "invalid" if unsatisfiable; None to ignore
+    m = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else total - 1
+    else:
+        start = max(total - int(m.group(2)), 0)
+        end = total - 1
+    if start >= total or start > end:
+        return "invalid"
+    return start, min(end, total - 1)
+
+
+@router.get('/api/export')
+def api_export(request: Request, folder: str = None, query: str = None, fmt: str = Query('tar', alias='format')):
+    if fmt not in ('tar', 'zip'):
+        raise HTTPException(status_code=400, detail="format must be tar or zip")
+    ref = folder_ref(folder)
+    if ref is None or not ref.exists():
+        raise HTTPException(status_code=404, detail="Folder not found")
+    sf = ref.folder
+    lib = current()
+    members = _export_members(lib, sf, query)
+    name = (sf.replace('/', '_') if sf else 'images') + ('-search' if query else '') + '.' + fmt
+    headers = {"Content-Disposition": f'attachment; filename="{name}"'}
+
+    if fmt == 'zip':
+        headers["Accept-Ranges"] = "none"
+        return StreamingResponse(_zip_stream(lib.images_root, members), media_type="application/zip", headers=headers)
+
+    etag = _etag(members)
+    offsets, total = _cached_layout(etag, members)
+    headers.update({"Accept-Ranges": "bytes", "ETag": etag})
+    start, end, status = 0, total - 1, 200
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (not if_range or if_range == etag):
+        rng = _parse_range(range_header, total)
+        if rng == "invalid":
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{total}", **headers})
+        if rng:
+            start, end = rng
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_tar_stream(lib.images_root, members, offsets, total, start, end), status_code=status, media_type="application/x-tar", headers=headers)
+
+
+# -- import -----------------------------------------------------------------
+#
+# Archives are unpacked member by member: each file is copied in chunks to a
+# staging file (hashing it on the way), then renamed into the target folder
+# under a short per-folder lock and announced to the catalog. TAR uploads are
+# read as a forward-only stream; ZIP needs its central directory, which the
+# spooled upload file provides.
+
+
+def _tar_entries(fileobj):
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        for member in tf:
+            if member.isfile():
+                f = tf.extractfile(member)
+                if f is not None:
+                    yield member.name, f
+
+
+def _zip_entries(fileobj):
+    with zipfile.ZipFile(fileobj) as zf:
+        for info in zf.infolist():
+            if not info.is_dir():
+                with zf.open(info) as f:
+                    yield info.filename, f
+
+
+def _free_name(directory: Path, name: str):
+    dest = directory / name
+    n = 1
+    while dest.exists():
+        dest = directory / f"{Path(name).stem}-{n}{Path(name).suffix}"
+        n += 1
+    return dest
+
+
+def _import_one(lib, name: str, src, target: str, seen: dict):
+    # returns (status, rel) with status "imported", "duplicate" or "skipped";
+    # files are staged in the library's tmp/ (same filesystem, so moves are renames)
+    images_dir = lib.images_root
+    parts = relative_parts(images_dir, Path(target) / name if target else name)
+    if not parts:
+        return "skipped", None
+    mime = mimetypes.guess_type(parts[-1])[0] or "application/octet-stream"
+    if not mime.startswith("image/"):
+        return "skipped", None
+    tmp = lib.tmp_dir / uuid.uuid4().hex
+    digest = hashlib.sha256()
+    try:
+        with tmp.open('wb') as out:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        sha = digest.hexdigest()
+        if sha in seen:
+            return "duplicate", seen[sha]
+        parent = '/'.join(parts[:-1])
+        with locks.locked(files_in=[parent]):
+            dest_dir = images_dir / parent
+            dest_dir.mkdir(parents=True, exist_ok=True)
+            dest = _free_name(dest_dir, parts[-1])
+            os.replace(tmp, dest)
+            catalog.add_file(dest)
+        rel = str(dest.relative_to(images_dir)).replace('\\', '/')
+        seen[sha] = rel
+        return "imported", rel
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+@router.post('/api/import')
+def api_import(file: UploadFile = File(...), folder: str = Form(None)):
+    ref = folder_ref(folder)
+    if ref is None:
+        return {"ok": False, "error": "invalid folder"}
+    target = ref.folder
+    lib = current()
+    fname = (file.filename or '').lower()
+    entries = _zip_entries(file.file) if fname.endswith('.zip') else _tar_entries(file.file)
+    seen = {}  # sha256 -> rel, to drop identical files within one archive
+    counts = {"imported": 0, "duplicate": 0, "skipped": 0}
+    try:
+        for name, src in entries:
+            status, _rel = _import_one(lib, name, src, target, seen)
+            counts[status] += 1
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        return {"ok": False, "error": f"invalid archive: {e}", **counts}
+
+    # record upload time and content hash for every imported file in one tags.json write
+    if seen:
+        now = datetime.datetime.utcnow().isoformat() + 'Z'
+        with locks.locked(meta=[locks.TAGS]):
+            tags_file = lib.images_root / 'tags.json'
+            data = {}
+            if tags_file.exists():
+                try:
+                    data = json.loads(tags_file.read_text())
+                except Exception:
+                    data = {}
+            for sha, rel in seen.items():
+                entry = data.get(rel)
+                if not isinstance(entry, dict):
+                    entry = {"tags": entry if isinstance(entry, list) else []}
+                entry.setdefault('uploaded_at', now)
+                entry['sha256'] = sha
+                data[rel] = entry
+            tags_file.write_text(json.dumps(data, indent=2))
+    return {"ok": True, "folder": f"/{target}", **counts}
@@ -1,14 +1,22 @@
 from fastapi import APIRouter, Request, UploadFile, File, Form, Depends, HTTPException, Body
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
+from starlette.concurrency import run_in_threadpool
 from pathlib import Path
 import uuid
 import shutil
 import mimetypes
 import os
 import json
+import re
 import datetime
-from app.config import DATA_DIR
+from app import catalog
+from app import locks
+from app import tagfile
+from app.resolver import folder_ref, image_ref
+from app import phash
+from app.timeline import DEFAULT_PAGE, decode_cursor
+from app.templating import templates, render_fragment
+from app.libraries import current
 
 # optional Pillow import for EXIF
 try:
@@ -19,57 +27,85 @@ except Exception:
     TAGS = {}
 
 router = APIRouter()
-BASE_DIR = Path(__file__).resolve().parent.parent
-templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 
-images_dir = Path(DATA_DIR) / "images"
-images_dir.mkdir(parents=True, exist_ok=True)
+
+def _image_entries(directory: Path, folder: str):
+    files = []
+    for p in directory.iterdir():
+        if p.is_file():
+            mime = mimetypes.guess_type(p.name)[0] or "application/octet-stream"
+            if mime.startswith("image/"):
+                files.append({"name": p.name, "url": f"/images/{folder}/{p.name}" if folder else f"/images/{p.name}"})
+    files.sort(key=lambda x: x["name"], reverse=True)
+    return files
+
+
+def _image_grid(lib, directory: Path, folder: str):
+    # cached grid of a folder's own images; None when it has none
+    def render():
+        files = _image_entries(directory, folder)
+        return render_fragment("_image_grid.html", images=files, folder=folder) if files else ""
+    html, _etag = lib.fragments.get_or_render(("grid", folder), lib.fragments.version(folder, direct=True), render)
+    return html or None
+
+
+def _folder_card(lib, p: Path):
+    # cached card for a top-level folder: subtree stats plus up to 4 previews
+    def render():
+        previews = []
+        try:
+            for q in sorted(p.iterdir()):
+                if q.is_file():
+                    mime = mimetypes.guess_type(q.name)[0] or "application/octet-stream"
+                    if mime.startswith("image/"):
+                        previews.append({"name": q.name, "url": f"/images/{p.name}/{q.name}"})
+                        if len(previews) >= 4:
+                            break
+        except Exception:
+            previews = []
+        f = {"name": p.name, "previews": previews, "stats": lib.stats.get(p.name)}
+        return render_fragment("_folder_card.html", f=f)
+    html, _etag = lib.fragments.get_or_render(("card", p.name), lib.fragments.version(p.name), render)
+    return html
+
+
+def _html_page(request: Request, html: str, etag: str):
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    sent = [t.strip() for t in request.headers.get("if-none-match", "").split(",")]
+    if etag in sent or "*" in sent:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
 
 
 @router.get("/gallery", response_class=HTMLResponse)
 async def gallery(request: Request, folder: str = None):
-    # If folder provided, show images in that folder; otherwise show folders and root images
-    context = {"request": request}
+    # If folder provided, show images in that folder; otherwise show folders and root images.
+    # Pages are assembled from cached fragments and served from memory until a
+    # mutation bumps the folder's version.
+    lib = current()
     if folder:
-        folder_path = images_dir / folder
-        if not folder_path.exists() or not folder_path.is_dir():
+        ref = folder_ref(folder)
+        if ref is None or not ref.exists():
             raise HTTPException(status_code=404, detail="Folder not found")
-        files = []
-        for p in folder_path.iterdir():
-            if p.is_file():
-                mime = mimetypes.guess_type(p.name)[0] or "application/octet-stream"
-                if mime.startswith("image/"):
-                    files.append({"name": p.name, "url": f"/images/{folder}/{p.name}"})
-        files.sort(key=lambda x: x["name"], reverse=True)
-        context.update({"images": files, "folder": folder})
-        return templates.TemplateResponse("index.html", context)
+        folder = ref.folder
+
+        def render():
+            return render_fragment("index.html", folder=folder, grid=_image_grid(lib, ref.path, folder))
+        html, etag = lib.fragments.get_or_render(("page", folder), lib.fragments.version(folder, direct=True), render)
+        return _html_page(request, html, etag)
 
     # root gallery: list folders and root images
-    folders = []
-    images = []
-    for p in images_dir.iterdir():
-        if p.is_dir():
-            # build a small preview list of up to 4 images inside the folder
-            previews = []
-            try:
-                for q in sorted(p.iterdir()):
-                    if q.is_file():
-                        mime = mimetypes.guess_type(q.name)[0] or "application/octet-stream"
-                        if mime.startswith("image/"):
-                            previews.append({"name": q.name, "url": f"/images/{p.name}/{q.name}"})
-                            if len(previews) >= 4:
-                                break
-            except Exception:
-                previews = []
-            folders.append({"name": p.name, "previews": previews})
-        elif p.is_file():
-            mime = mimetypes.guess_type(p.name)[0] or "application/octet-stream"
-            if mime.startswith("image/"):
-                images.append({"name": p.name, "url": f"/images/{p.name}"})
-    folders.sort(key=lambda x: x["name"])
-    images.sort(key=lambda x: x["name"], reverse=True)
-    context.update({"folders": folders, "images": images})
-    return templates.TemplateResponse("index.html", context)
+    def render():
+        cards = []
+        for p in sorted(lib.images_root.iterdir()):
+            if p.name.startswith('.'):
+                # .trash and other internal entries are not part of the library
+                continue
+            if p.is_dir():
+                cards.append(_folder_card(lib, p))
+        return render_fragment("index.html", folders=cards, grid=_image_grid(lib, lib.images_root, ""))
+    html, etag = lib.fragments.get_or_render(("page", ""), lib.fragments.version(""), render)
+    return _html_page(request, html, etag)
 
 
 @router.get("/upload", response_class=HTMLResponse)
@@ -79,87 +115,111 @@ async def upload_form(request: Request, folder: str = None):
 
 
 @router.post("/upload")
-async def upload_image(file: UploadFile = File(...), title: str = Form(None), folder: str = Form(None)):
+def upload_image(file: UploadFile = File(...), title: str = Form(None), folder: str = Form(None)):
+    ref = folder_ref(folder)
+    if ref is None:
+        raise HTTPException(status_code=400, detail="Invalid folder name")
+    folder = ref.folder
     ext = Path(file.filename).suffix or ""
     fname = f"{uuid.uuid4().hex}{ext}"
-    dest_dir = images_dir
-    if folder:
-        dest_dir = images_dir / folder
-        dest_dir.mkdir(parents=True, exist_ok=True)
+    dest_dir = ref.path
     dest = dest_dir / fname
-    with dest.open("wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # only this folder is locked while the body is written and indexed;
+    # TAGS is library-wide and held just for the tags.json update below
+    with locks.locked(files_in=[folder]):
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        with dest.open("wb") as buffer:
+            shutil.copyfileobj(file.file, buffer)
+        catalog.add_file(dest)
     # (No thumbnail generation) -- previews use full images scaled in the client
     # Record upload time and initialize tags metadata
-    try:
-        tags_file = images_dir / 'tags.json'
-        data = {}
-        if tags_file.exists():
-            try:
-                data = json.loads(tags_file.read_text())
-            except Exception:
-                data = {}
-        rel = f"{folder}/{fname}" if folder else fname
-        entry = data.get(rel)
-        if not isinstance(entry, dict):
-            # migrate previous simple list entry to object
-            tags = entry if isinstance(entry, list) else []
-            data[rel] = {"tags": tags, "uploaded_at": datetime.datetime.utcnow().isoformat() + 'Z'}
-        else:
-            entry.setdefault('uploaded_at', datetime.datetime.utcnow().isoformat() + 'Z')
-            data[rel] = entry
-        tags_file.write_text(json.dumps(data, indent=2))
-    except Exception:
-        pass
+    with locks.locked(meta=[locks.TAGS]):
+        try:
+            tags_file = current().images_root / 'tags.json'
+            data = {}
+            if tags_file.exists():
+                try:
+                    data = json.loads(tags_file.read_text())
+                except Exception:
+                    data = {}
+            rel = f"{folder}/{fname}" if folder else fname
+            entry = data.get(rel)
+            if not isinstance(entry, dict):
+                # migrate previous simple list entry to object
+                tags = entry if isinstance(entry, list) else []
+                data[rel] = {"tags": tags, "uploaded_at": datetime.datetime.utcnow().isoformat() + 'Z'}
+            else:
+                entry.setdefault('uploaded_at', datetime.datetime.utcnow().isoformat() + 'Z')
+                data[rel] = entry
+            tags_file.write_text(json.dumps(data, indent=2))
+        except Exception:
+            pass
     if folder:
         return RedirectResponse(url=f"/gallery?folder={folder}", status_code=303)
     return RedirectResponse(url="/gallery", status_code=303)
 
 
 @router.post("/gallery/create_folder")
-async def create_folder(name: str = Form(...)):
-    safe = name.strip()
-    if not safe:
+def create_folder(name: str = Form(...)):
+    ref = folder_ref(name)
+    if ref is None or not ref.folder:
         raise HTTPException(status_code=400, detail="Invalid folder name")
-    path = images_dir / safe
-    path.mkdir(parents=True, exist_ok=True)
+    with locks.locked(trees=[ref.folder]):
+        ref.path.mkdir(parents=True, exist_ok=True)
+        catalog.add_folder(ref.path)
     return RedirectResponse(url="/gallery", status_code=303)
 
 
 @router.post("/gallery/{folder}/delete")
-async def delete_folder(folder: str):
-    path = images_dir / folder
-    if not path.exists() or not path.is_dir():
+def delete_folder(folder: str):
+    ref = folder_ref(folder)
+    if ref is None or not ref.folder:
         raise HTTPException(status_code=404, detail="Folder not found")
-    # remove all files and dir
-    for p in path.iterdir():
-        if p.is_file():
-            p.unlink()
-        elif p.is_dir():
-            shutil.rmtree(p)
-    path.rmdir()
+    path = ref.path
+    with locks.locked(trees=[ref.folder]):
+        if not ref.exists():
+            raise HTTPException(status_code=404, detail="Folder not found")
+        # remove all files and dir
+        for p in path.iterdir():
+            if p.is_file():
+                p.unlink()
+            elif p.is_dir():
+                shutil.rmtree(p)
+        path.rmdir()
+        catalog.remove_tree(path)
     return RedirectResponse(url="/gallery", status_code=303)
 
 
 @router.post("/gallery/{folder}/rename")
-async def rename_folder(folder: str, new_name: str = Form(...)):
-    src = images_dir / folder
-    dst = images_dir / new_name.strip()
-    if not src.exists() or not src.is_dir():
+def rename_folder(folder: str, new_name: str = Form(...)):
+    src = folder_ref(folder)
+    dst = folder_ref(new_name)
+    if src is None or not src.folder:
         raise HTTPException(status_code=404, detail="Folder not found")
-    if dst.exists():
-        raise HTTPException(status_code=400, detail="Destination already exists")
-    src.rename(dst)
+    if dst is None or not dst.folder:
+        raise HTTPException(status_code=400, detail="Invalid folder name")
+    with locks.locked(trees=[src.folder, dst.folder]):
+        if not src.exists():
+            raise HTTPException(status_code=404, detail="Folder not found")
+        if dst.path.exists():
+            raise HTTPException(status_code=400, detail="Destination already exists")
+        src.path.rename(dst.path)
+        catalog.move_tree(src.path, dst.path)
+        tagfile.follow_moves([(src.folder, dst.folder)])
     return RedirectResponse(url="/gallery", status_code=303)
 
 
 @router.post("/gallery/{folder}/delete_image")
-async def delete_image(folder: str, filename: str = Form(...)):
-    path = images_dir / folder / filename
-    if not path.exists() or not path.is_file():
+def delete_image(folder: str, filename: str = Form(...)):
+    ref = image_ref(folder, filename)
+    if ref is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    path.unlink()
-    return RedirectResponse(url=f"/gallery?folder={folder}", status_code=303)
+    with locks.locked(files_in=[ref.folder]):
+        if not ref.exists():
+            raise HTTPException(status_code=404, detail="Image not found")
+        ref.path.unlink()
+        catalog.remove_file(ref.path)
+    return RedirectResponse(url=f"/gallery?folder={ref.folder}", status_code=303)
 
 
 def _read_exif(path: Path):
@@ -181,10 +241,59 @@ def _read_exif(path: Path):
 async def api_image_exif(folder: str = None, filename: str = None):
     if not filename:
         return {"exif": {}}
-    path = images_dir / filename if not folder else images_dir / folder / filename
-    if not path.exists() or not path.is_file():
+    ref = image_ref(folder, filename)
+    if ref is None or not ref.exists():
         raise HTTPException(status_code=404, detail="Image not found")
-    return {"exif": _read_exif(path)}
+    return {"exif": _read_exif(ref.path)}
+
+
+@router.get('/api/similar')
+def api_similar(folder: str = None, filename: str = None, max_distance: int = None):
+    # near-duplicates of one image, or duplicate groups within a folder (whole library by default)
+    if not phash.available():
+        return {"ok": False, "error": "similarity search unavailable"}
+    kwargs = {"max_distance": max_distance} if max_distance is not None else {}
+    if filename:
+        ref = image_ref(folder, filename)
+        similar = current().phash.similar(ref.rel, **kwargs) if ref else None
+        if similar is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        return {"ok": True, "file": ref.rel, "similar": similar}
+    fref = folder_ref(folder)
+    if fref is None:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    return {"ok": True, "groups": current().phash.duplicates(fref.folder or None, **kwargs)}
+
+
+_BUCKET = re.compile(r"\d{4}(-\d{2}(-\d{2})?)?")
+
+
+def _timeline_bucket(bucket):
+    bucket = (bucket or '').strip()
+    if bucket and not _BUCKET.fullmatch(bucket):
+        raise HTTPException(status_code=400, detail="bucket must be YYYY, YYYY-MM or YYYY-MM-DD")
+    return bucket
+
+
+@router.get('/api/timeline')
+def api_timeline(bucket: str = None):
+    # capture-date buckets below `bucket` (years, months of a year, days of a month) with counts
+    bucket = _timeline_bucket(bucket)
+    timeline = current().timeline
+    return {"bucket": bucket, "count": timeline.count(bucket), "buckets": timeline.buckets(bucket)}
+
+
+@router.get('/api/timeline/images')
+def api_timeline_images(bucket: str = None, cursor: str = None, limit: int = DEFAULT_PAGE):
+    # one page of a bucket's images, newest first; pass next_cursor back for the next page
+    bucket = _timeline_bucket(bucket)
+    position = None
+    if cursor:
+        position = decode_cursor(cursor)
+        if position is None:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+    items, next_cursor = current().timeline.page(bucket, position, limit)
+    return {"bucket": bucket, "items": items, "next_cursor": next_cursor}
 
 
 @router.post('/api/create_folder')
@@ -201,9 +310,18 @@ async def api_create_folder(request: Request, name: str = Form(None)):
         folder_name = name
     if not folder_name:
         return {"ok": False, "error": "missing name"}
-    path = images_dir / folder_name.strip()
-    path.mkdir(parents=True, exist_ok=True)
-    return {"ok": True, "folder": folder_name}
+    ref = folder_ref(folder_name)
+    if ref is None or not ref.folder:
+        return {"ok": False, "error": "invalid name"}
+    # lock waits block, so the locked part runs in a worker thread
+    return await run_in_threadpool(_api_create_folder, ref)
+
+
+def _api_create_folder(ref):
+    with locks.locked(trees=[ref.folder]):
+        ref.path.mkdir(parents=True, exist_ok=True)
+        catalog.add_folder(ref.path)
+    return {"ok": True, "folder": ref.folder}
 
 
 @router.post('/api/delete_folder')
@@ -219,15 +337,24 @@ async def api_delete_folder(request: Request, folder: str = Form(None)):
         folder_name = folder
     if not folder_name:
         return {"ok": False, "error": "missing folder"}
-    path = images_dir / folder_name
-    if not path.exists() or not path.is_dir():
+    ref = folder_ref(folder_name)
+    if ref is None or not ref.folder:
         return {"ok": False, "error": "not found"}
-    for p in path.iterdir():
-        if p.is_file():
-            p.unlink()
-        elif p.is_dir():
-            shutil.rmtree(p)
-    path.rmdir()
+    return await run_in_threadpool(_api_delete_folder, ref)
+
+
+def _api_delete_folder(ref):
+    path = ref.path
+    with locks.locked(trees=[ref.folder]):
+        if not ref.exists():
+            return {"ok": False, "error": "not found"}
+        for p in path.iterdir():
+            if p.is_file():
+                p.unlink()
+            elif p.is_dir():
+                shutil.rmtree(p)
+        path.rmdir()
+        catalog.remove_tree(path)
     return {"ok": True}
 
 
@@ -247,10 +374,18 @@ async def api_delete_image(request: Request, folder: str = Form(None), filename:
     file_name = file_name or filename
     if not file_name:
         return {"ok": False, "error": "missing filename"}
-    path = images_dir / file_name if not folder_name else images_dir / folder_name / file_name
-    if not path.exists() or not path.is_file():
+    ref = image_ref(folder_name, file_name)
+    if ref is None:
         return {"ok": False, "error": "not found"}
-    path.unlink()
+    return await run_in_threadpool(_api_delete_image, ref)
+
+
+def _api_delete_image(ref):
+    with locks.locked(files_in=[ref.folder]):
+        if not ref.exists():
+            return {"ok": False, "error": "not found"}
+        ref.path.unlink()
+        catalog.remove_file(ref.path)
     return {"ok": True}
 
 
@@ -274,26 +409,35 @@ async def api_rename_image(request: Request, folder: str = Form(None), old_name:
     if not old or not new:
         return {"ok": False, "error": "missing old or new name"}
 
-    src = images_dir / old if not folder_name else images_dir / folder_name / old
-    if not src.exists() or not src.is_file():
+    src = image_ref(folder_name, old)
+    if src is None:
         return {"ok": False, "error": "source not found"}
-
     # Preserve extension if new name has none
     new_path = Path(new)
     if not new_path.suffix:
-        new = new + src.suffix
-
-    dst = images_dir / new if not folder_name else images_dir / folder_name / new
-    if dst.exists():
-        return {"ok": False, "error": "destination exists"}
-
-    try:
-        src.rename(dst)
-        # rename thumbnail if exists
-        # (no thumbnails present) nothing else to rename
-        return {"ok": True, "new_name": dst.name}
-    except Exception as e:
-        return {"ok": False, "error": str(e)}
+        new = new + Path(src.name).suffix
+    dst = src.with_name(new)
+    if dst is None:
+        return {"ok": False, "error": "invalid new name"}
+    return await run_in_threadpool(_api_rename_image, src, dst)
+
+
+def _api_rename_image(src, dst):
+    with locks.locked(files_in=[src.folder]):
+        if not src.exists():
+            return {"ok": False, "error": "source not found"}
+        if dst.exists():
+            return {"ok": False, "error": "destination exists"}
+
+        try:
+            src.path.rename(dst.path)
+            catalog.move_file(src.path, dst.path)
+            tagfile.follow_moves([(src.rel, dst.rel)])
+            # rename thumbnail if exists
+            # (no thumbnails present) nothing else to rename
+            return {"ok": True, "new_name": dst.name}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
 
 
 @router.post('/debug/echo')
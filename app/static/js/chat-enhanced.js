@@ -37,7 +37,8 @@ document.addEventListener('DOMContentLoaded', ()=>{
           try{
             const execRes = await fetch('/agent/chat', {
               method:'POST', headers:{'Content-Type':'application/json'},
-              body: JSON.stringify({message: text, confirm: true, action: j.raw_action})
+              // send the plan id so the server runs exactly what was previewed
+              body: JSON.stringify({message: text, confirm: true, plan_id: j.plan_id})
             })
             const execJson = await execRes.json()
             const execDetails = document.createElement('div')
@@ -53,7 +54,8 @@ document.addEventListener('DOMContentLoaded', ()=>{
             btn.textContent = 'Error'
           }
         })
-        previewBox.appendChild(btn)
+        // a preview that failed has no plan to confirm
+        if(j.plan_id) previewBox.appendChild(btn)
         loadingEl.parentNode.appendChild(previewBox)
         box.scrollTop = box.scrollHeight
         saveHistory()
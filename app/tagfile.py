@@ -0,0 +1,53 @@
+import json
+from app import locks
+from app.libraries import current
+
+
+# tags.json holds per-image metadata ({"tags": [...], "uploaded_at": ...})
+# keyed by root-relative path. Entries follow their files when files or
+# folders are moved or renamed, so a catalog rebuild sees the same tags the
+# incremental hooks carried along. Entries of files sent to the trash are
+# kept; restoring them from the trash picks their tags up again.
+
+
+def load(root):
+    try:
+        data = json.loads((root / 'tags.json').read_text())
+    except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _within(key, paths):
+    # the entry of `paths` that is `key` itself or one of its folders, or None
+    parts = key.split('/')
+    for i in range(len(parts), 0, -1):
+        prefix = '/'.join(parts[:i])
+        if prefix in paths:
+            return prefix
+    return None
+
+
+def follow_moves(moves):
+    # re-key entries after files or folders moved; `moves` are (src, dst)
+    # root-relative paths. Entries already sitting at a destination belong to
+    # files that are gone and are dropped.
+    moves = {s: d for s, d in moves if s and d and s != d}
+    if not moves:
+        return
+    targets = set(moves.values())
+    with locks.locked(meta=[locks.TAGS]):
+        tags_file = current().images_root / 'tags.json'
+        data = load(tags_file.parent)
+        moved = {}
+        stale = 0
+        for key in list(data):
+            src = _within(key, moves)
+            if src is not None:
+                moved[moves[src] + key[len(src):]] = data.pop(key)
+            elif _within(key, targets) is not None:
+                data.pop(key)
+                stale += 1
+        if moved or stale:
+            data.update(moved)
+            tags_file.write_text(json.dumps(data, indent=2, ensure_ascii=False))
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import threading
+from fastapi.templating import Jinja2Templates
+from markupsafe import Markup
+from app.config import TEMPLATE_AUTO_RELOAD
+from app.folder_stats import relative_parts
+
+# One template environment for every router. Jinja compiles each template
+# once and keeps it in its own cache; with auto_reload off it also skips the
+# per-render stat of the template file.
+templates = Jinja2Templates(directory=str(Path(__file__).resolve().parent / "templates"))
+templates.env.auto_reload = TEMPLATE_AUTO_RELOAD
+
+
+# Rendered HTML fragments (folder cards, image grids, whole gallery pages)
+# cached by folder version. Every folder has two counters bumped by the
+# catalog hooks: `direct` when its own files/subfolders change and `subtree`
+# when anything below it changes. A fragment is stored under the version it
+# was rendered from, so a bumped counter simply stops matching and the stale
+# entry ages out of the LRU.
+
+
+class FragmentCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (version, html, etag)
+        self._bytes = 0
+        self._direct = {}
+        self._subtree = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    # -- versions -----------------------------------------------------------
+
+    def version(self, folder='', direct=False):
+        counters = self._direct if direct else self._subtree
+        return (self._epoch, counters.get(folder or '', 0))
+
+    def _bump(self, folder):
+        parts = folder.split('/') if folder else []
+        with self._lock:
+            self._direct[folder] = self._direct.get(folder, 0) + 1
+            for i in range(len(parts) + 1):
+                f = '/'.join(parts[:i])
+                self._subtree[f] = self._subtree.get(f, 0) + 1
+
+    def _bump_parent(self, path):
+        parts = relative_parts(self.root, path)
+        if parts:
+            self._bump('/'.join(parts[:-1]))
+
+    def _bump_tree(self, path):
+        # the folder itself and, for the listing that contains it, its parent
+        parts = relative_parts(self.root, path)
+        if parts:
+            self._bump('/'.join(parts))
+            self._bump('/'.join(parts[:-1]))
+
+    def invalidate(self):
+        # another worker changed the tree: no counter can be trusted any more
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    # catalog hooks
+    add_file = _bump_parent
+    remove_file = _bump_parent
+    set_tags = _bump_parent
+    add_folder = _bump_tree
+    add_tree = _bump_tree
+    remove_tree = _bump_tree
+
+    def move_file(self, src, dst):
+        self._bump_parent(src)
+        self._bump_parent(dst)
+
+    def move_tree(self, src, dst):
+        self._bump_tree(src)
+        self._bump_tree(dst)
+
+    # -- cache --------------------------------------------------------------
+
+    def get_or_render(self, key, version, render):
+        # cached (html, etag) for `key` at `version`, rendering on a miss
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None and hit[0] == version:
+                self._entries.move_to_end(key)
+                return hit[1], hit[2]
+        html = Markup(render())
+        etag = '"' + hashlib.sha1(html.encode('utf8')).hexdigest() + '"'
+        size = len(html)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            if size <= self.max_bytes:
+                self._entries[key] = (version, html, etag)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _k, (_v, evicted, _e) = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+        return html, etag
+
+
+def render_fragment(name: str, **context):
+    return templates.get_template(name).render(**context)
+
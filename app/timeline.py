@@ -0,0 +1,466 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import base64
+import calendar
+import datetime
+import json
+import mimetypes
+import os
+import struct
+import threading
+import time
+from app.folder_stats import relative_parts
+
+# optional Pillow import; without it capture dates fall back to upload time/mtime
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+
+# Capture-date timeline. Every image gets one timestamp: EXIF DateTimeOriginal
+# (or DateTime), else the upload time recorded in tags.json, else the file
+# mtime. EXIF times carry no zone, so all timestamps are kept as "wall clock
+# seconds" (UTC arithmetic on the literal date) and bucketed by that date.
+#
+# In memory the index is a sorted list of day keys ("YYYY-MM-DD"), one sorted
+# list of (-timestamp, path) per day (newest first) and running counts per
+# year and month. Bucket listings and page lookups are bisections; nothing is
+# scanned per request. The path -> timestamp map is persisted so a restart
+# only has to read EXIF for files that appeared in the meantime; those are
+# dated by upload time or mtime at once and refined from EXIF in the
+# background, so queries never wait for image reads.
+
+SAVE_EVERY = 256
+BACKFILL_BATCH = 1024
+DEFAULT_PAGE = 100
+MAX_PAGE = 500
+
+_EXIF_IFD = 0x8769
+_DATETIME_ORIGINAL = 36867
+_DATETIME = 306
+
+_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="timeline")
+
+
+def _is_image(rel):
+    mime = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+    return mime.startswith("image/")
+
+
+def _exif_time(path: Path):
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as img:
+            exif = img.getexif()
+            value = exif.get_ifd(_EXIF_IFD).get(_DATETIME_ORIGINAL) or exif.get(_DATETIME)
+    except Exception:
+        return None
+    try:
+        t = time.strptime(str(value).strip('\0 ')[:19], "%Y:%m:%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    return calendar.timegm(t)
+
+
+def _iso_time(value):
+    # uploaded_at values look like 2024-05-01T12:00:00.123456Z
+    if not isinstance(value, str):
+        return None
+    try:
+        return calendar.timegm(datetime.datetime.fromisoformat(value.rstrip('Z')).timetuple())
+    except ValueError:
+        return None
+
+
+def _fallback_time(path: Path, uploaded_at=None, mtime=None):
+    # upload time, then mtime; no image read
+    ts = _iso_time(uploaded_at)
+    if ts is None:
+        if mtime is None:
+            try:
+                mtime = path.stat().st_mtime
+            except OSError:
+                mtime = 0
+        ts = int(mtime)
+    return ts
+
+
+def capture_time(path: Path, uploaded_at=None, mtime=None):
+    # seconds for the timeline; EXIF, then upload time, then mtime
+    ts = _exif_time(path)
+    return ts if ts is not None else _fallback_time(path, uploaded_at, mtime)
+
+
+def _day(ts):
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def _iso(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts))
+
+
+def encode_cursor(day, key):
+    raw = json.dumps([day, key[0], key[1]], ensure_ascii=False).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    # (day, (-ts, path)) or None if malformed
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        day, neg_ts, rel = json.loads(raw)
+        return str(day), (int(neg_ts), str(rel))
+    except Exception:
+        return None
+
+
+class TimelineIndex:
+    def __init__(self, root: Path, store: Path, stats):
+        self.root = Path(root)
+        self.store = Path(store)
+        self.stats = stats  # FolderStats of the same root; lists files without walking disk
+        self._dates = None  # rel -> ts; the source of truth
+        self._lock = threading.RLock()
+        self._unsaved = 0
+        self._loads = 0  # bumped on every (re)load; stale backfill jobs check it
+        self._backfilling = 0  # background EXIF jobs still running
+        self._pending = set()  # dated by fallback only; EXIF not read yet
+        self._reset_buckets()
+
+    def _reset_buckets(self):
+        self._day_keys = []  # sorted
+        self._days = {}  # day -> sorted [(-ts, rel)]
+        self._counts = {}  # "YYYY" and "YYYY-MM" -> images
+
+    def _rel(self, path):
+        parts = relative_parts(self.root, path)
+        return '/'.join(parts) if parts else None
+
+    # -- persistence --------------------------------------------------------
+    #
+    # <u64 count><count x i64 timestamps><"\n"-joined utf-8 paths>
+
+    def _load(self):
+        try:
+            raw = self.store.read_bytes()
+            (n,) = struct.unpack_from('<Q', raw)
+            stamps = array('q')
+            stamps.frombytes(raw[8:8 + 8 * n])
+            blob = raw[8 + 8 * n:]
+            paths = blob.decode('utf8').split('\n') if n else []
+            if len(paths) != n:
+                return {}
+            return dict(zip(paths, stamps))
+        except Exception:
+            return {}
+
+    def save(self):
+        with self._lock:
+            if self._dates is None:
+                return
+            # fallback dates are not stored; the next load dates them again
+            paths = [p for p in self._dates if p not in self._pending]
+            stamps = array('q', (self._dates[p] for p in paths))
+            self._unsaved = 0
+        self.store.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.store.with_name(f"{self.store.name}.{os.getpid()}.tmp")
+        with tmp.open('wb') as f:
+            f.write(struct.pack('<Q', len(paths)))
+            f.write(stamps.tobytes())
+            f.write('\n'.join(paths).encode('utf8'))
+        os.replace(tmp, self.store)
+
+    def flush(self):
+        if self._unsaved:
+            self.save()
+
+    def invalidate(self):
+        with self._lock:
+            self._dates = None
+            self._pending = set()
+            self._reset_buckets()
+
+    def _uploaded_at(self):
+        try:
+            data = json.loads((self.root / 'tags.json').read_text())
+        except Exception:
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return {rel: e.get('uploaded_at') for rel, e in data.items() if isinstance(e, dict)}
+
+    def _ensure(self, wait=False):
+        # load stored timestamps and reconcile them with the library tree:
+        # drop files that are gone, date the ones that are new (from EXIF in
+        # the background unless `wait`)
+        with self._lock:
+            if self._dates is not None:
+                return
+            dates = self._load()
+        records = {rel: mtime for rel, _size, mtime in self.stats.iter_records() if _is_image(rel)}
+        dates = {rel: ts for rel, ts in dates.items() if rel in records}
+        missing = [rel for rel in records if rel not in dates]
+        if missing:
+            uploaded = self._uploaded_at()
+            if wait:
+                for i in range(0, len(missing), BACKFILL_BATCH):
+                    batch = missing[i:i + BACKFILL_BATCH]
+                    stamps = _pool.map(lambda r: capture_time(self.root / r, uploaded.get(r), records[r]), batch)
+                    dates.update(zip(batch, stamps))
+            else:
+                for rel in missing:
+                    dates[rel] = _fallback_time(self.root / rel, uploaded.get(rel), records[rel])
+        with self._lock:
+            self._dates = dates
+            self._loads += 1
+            self._rebuild()
+            self._pending = set() if wait else set(missing)
+            self._backfilling = 0
+            self._submit(missing if not wait else [])
+        if missing and wait:
+            self.save()
+
+    def _submit(self, rels):
+        # queue EXIF reads for `rels`; called with the lock held
+        for i in range(0, len(rels), BACKFILL_BATCH):
+            self._backfilling += 1
+            _pool.submit(self._date_batch, rels[i:i + BACKFILL_BATCH], self._loads)
+
+    def _date_batch(self, rels, load):
+        found = [(rel, _exif_time(self.root / rel)) for rel in rels]
+        with self._lock:
+            if load != self._loads or self._dates is None:
+                return
+            for rel, ts in found:
+                # hooks may have re-dated, moved or deleted it meanwhile
+                if rel in self._pending:
+                    self._pending.discard(rel)
+                    if ts is not None:
+                        self._store(rel, ts)
+            self._backfilling -= 1
+            if not self._backfilling:
+                # files moved while queued are still pending under their new path
+                self._submit(sorted(self._pending))
+            done = not self._backfilling
+        if done:
+            self.save()
+
+    # -- bucket maintenance -------------------------------------------------
+
+    def _rebuild(self):
+        self._reset_buckets()
+        for rel, ts in self._dates.items():
+            self._days.setdefault(_day(ts), []).append((-ts, rel))
+        for day, items in self._days.items():
+            items.sort()
+            for key in (day[:4], day[:7]):
+                self._counts[key] = self._counts.get(key, 0) + len(items)
+        self._day_keys = sorted(self._days)
+
+    def backfill(self):
+        self.invalidate()
+        self._ensure(wait=True)
+        return len(self._dates or {})
+
+    def _count(self, day, delta):
+        for key in (day[:4], day[:7]):
+            n = self._counts.get(key, 0) + delta
+            if n:
+                self._counts[key] = n
+            else:
+                self._counts.pop(key, None)
+
+    def _place(self, rel, ts):
+        day = _day(ts)
+        items = self._days.get(day)
+        if items is None:
+            items = self._days[day] = []
+            insort(self._day_keys, day)
+        insort(items, (-ts, rel))
+        self._count(day, 1)
+
+    def _store(self, rel, ts):
+        if self._dates is None:
+            return
+        self._drop(rel)
+        self._dates[rel] = ts
+        self._place(rel, ts)
+        self._changed()
+
+    def _drop(self, rel):
+        if self._dates is None:
+            return None
+        ts = self._dates.pop(rel, None)
+        self._pending.discard(rel)
+        if ts is None:
+            return None
+        day = _day(ts)
+        items = self._days[day]
+        i = bisect_left(items, (-ts, rel))
+        if i < len(items) and items[i] == (-ts, rel):
+            del items[i]
+        if not items:
+            del self._days[day]
+            del self._day_keys[bisect_left(self._day_keys, day)]
+        self._count(day, -1)
+        self._changed()
+        return ts
+
+    def _changed(self):
+        self._unsaved += 1
+        # a running backfill saves once when it is done
+        if self._unsaved >= SAVE_EVERY and not self._backfilling:
+            _pool.submit(self.save)
+
+    # -- catalog hooks --------------------------------------------------------
+
+    def add_file(self, path):
+        rel = self._rel(path)
+        if not rel or not _is_image(rel):
+            return
+        with self._lock:
+            if self._dates is None:
+                return
+        # only the image header is read; uploads have no uploaded_at yet and
+        # fall back to their mtime, which is the upload time
+        ts = capture_time(self.root / rel)
+        with self._lock:
+            self._store(rel, ts)
+
+    def remove_file(self, path):
+        rel = self._rel(path)
+        if rel:
+            with self._lock:
+                self._drop(rel)
+
+    def move_file(self, src, dst):
+        src_rel, dst_rel = self._rel(src), self._rel(dst)
+        with self._lock:
+            pending = src_rel in self._pending
+            ts = self._drop(src_rel) if src_rel else None
+            if ts is not None and dst_rel and _is_image(dst_rel):
+                self._store(dst_rel, ts)
+                if pending:
+                    self._pending.add(dst_rel)
+                return
+        if dst_rel:
+            self.add_file(dst)
+
+    def _under(self, prefix):
+        prefix = prefix + '/'
+        return [rel for rel in self._dates if rel.startswith(prefix)]
+
+    def remove_tree(self, path):
+        rel = self._rel(path)
+        if not rel:
+            return
+        with self._lock:
+            if self._dates is None:
+                return
+            for r in self._under(rel):
+                self._drop(r)
+
+    def move_tree(self, src, dst):
+        src_rel, dst_rel = self._rel(src), self._rel(dst)
+        if not src_rel or not dst_rel:
+            self.invalidate()
+            return
+        with self._lock:
+            if self._dates is None:
+                return
+            for r in self._under(src_rel):
+                pending = r in self._pending
+                ts = self._drop(r)
+                self._store(dst_rel + r[len(src_rel):], ts)
+                if pending:
+                    self._pending.add(dst_rel + r[len(src_rel):])
+
+    def add_tree(self, path):
+        rel = self._rel(path)
+        if not rel:
+            return
+        with self._lock:
+            if self._dates is None:
+                return
+        for r in self.stats.iter_files(rel):
+            self.add_file(r)
+
+    # -- queries ------------------------------------------------------------
+
+    def _day_range(self, bucket):
+        # indexes [lo, hi) of the day keys inside a "", YYYY, YYYY-MM or YYYY-MM-DD bucket
+        if not bucket:
+            return 0, len(self._day_keys)
+        return bisect_left(self._day_keys, bucket), bisect_left(self._day_keys, bucket + '~')
+
+    def buckets(self, bucket=''):
+        # child buckets of `bucket` with image counts, newest first: years of
+        # the whole library, months of a year, days of a month
+        self._ensure()
+        with self._lock:
+            if not bucket:
+                keys = sorted((k for k in self._counts if len(k) == 4), reverse=True)
+                return [{"bucket": k, "count": self._counts[k]} for k in keys]
+            if len(bucket) == 4:
+                keys = (f"{bucket}-{m:02d}" for m in range(12, 0, -1))
+                return [{"bucket": k, "count": self._counts[k]} for k in keys if k in self._counts]
+            lo, hi = self._day_range(bucket)
+            return [{"bucket": d, "count": len(self._days[d])} for d in reversed(self._day_keys[lo:hi])]
+
+    def count(self, bucket=''):
+        self._ensure()
+        with self._lock:
+            if not bucket:
+                return len(self._dates)
+            if len(bucket) == 10:
+                return len(self._days.get(bucket, ()))
+            return self._counts.get(bucket, 0)
+
+    def page(self, bucket='', cursor=None, limit=DEFAULT_PAGE):
+        # (items, next cursor) of the images in `bucket`, newest first,
+        # continuing after `cursor` (a value returned by a previous call)
+        self._ensure()
+        limit = max(1, min(int(limit), MAX_PAGE))
+        out = []
+        with self._lock:
+            lo, hi = self._day_range(bucket)
+            i, start = hi - 1, 0
+            if cursor is not None:
+                day, key = cursor
+                # the cursor's day (if it still exists) continues after the
+                # cursor key; older days follow
+                i = bisect_right(self._day_keys, day, lo, hi) - 1
+                if i >= lo and self._day_keys[i] == day:
+                    start = bisect_right(self._days[day], key)
+            last = None
+            more = False
+            while i >= lo:
+                day = self._day_keys[i]
+                items = self._days[day]
+                take = items[start:start + limit - len(out)]
+                for neg_ts, rel in take:
+                    out.append({"file": rel, "url": f"/images/{rel}", "taken": _iso(-neg_ts)})
+                if take:
+                    last = (day, take[-1])
+                if start + len(take) < len(items):
+                    more = True
+                    break
+                i, start = i - 1, 0
+                if len(out) >= limit:
+                    more = i >= lo
+                    break
+        return out, (encode_cursor(*last) if more else None)
+
+
+if __name__ == '__main__':
+    # offline backfill: python -m app.timeline [tenant]
+    import sys
+    from app.libraries import DEFAULT_TENANT, clean_tenant, get_library
+    tenant = clean_tenant(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_TENANT)
+    if tenant is None:
+        sys.exit("invalid tenant name")
+    print(f"dated {get_library(tenant).timeline.backfill()} images")
@@ -0,0 +1,43 @@
+import pytest
+from app.actions import ActionError, action_dict, extract_json, parse_action
+
+
+def test_extract_json_balanced_and_apostrophes():
+    assert extract_json('{"intent": "tag", "filename": "Bob\'s cat.jpg"}')["filename"] == "Bob's cat.jpg"
+    text = 'Here\'s the action: {"intent": "move", "query": "a } b", "x": [1, {"y": 2}]} and {"second": 1}'
+    assert extract_json(text) == {"intent": "move", "query": "a } b", "x": [1, {"y": 2}]}
+    assert extract_json("{'intent': 'delete', 'query': \"Ann's\"}") == {"intent": "delete", "query": "Ann's"}
+    assert extract_json("{not json} then [1, 2]") == [1, 2]
+    assert extract_json('Step [1]: {"intent": "summarize"}') == {"intent": "summarize"}
+    assert extract_json("no json here") is None
+    assert extract_json("{" * 10000) is None
+
+
+def test_parse_action_normalizes_aliases():
+    a = parse_action({"intent": "rename", "filename": "a.jpg", "new_name": "b.jpg"})
+    assert (a.intent, a.old_name, a.new_name) == ("rename_image", "a.jpg", "b.jpg")
+    a = parse_action({"source": "Japan/Raw", "target": "Japan/Edited"})
+    assert (a.intent, a.source_folder, a.target_folder) == ("move_folder", "Japan/Raw", "Japan/Edited")
+    a = parse_action({"intent": "tag_image", "labels": "beach", "image": "x.jpg"})
+    assert (a.tags, a.filename) == (["beach"], "x.jpg")
+    assert parse_action(action_dict(a)) == a
+
+
+def test_parse_action_rejects_invalid():
+    with pytest.raises(ActionError):
+        parse_action({"intent": "launch_rockets"})
+    with pytest.raises(ActionError):
+        parse_action({"intent": "move_image", "query": "x"})
+    with pytest.raises(ActionError):
+        parse_action({"intent": "delete_folder", "folder": "  "})
+    with pytest.raises(ActionError):
+        parse_action(["intent"])
+
+
+def test_query_actions_need_a_query():
+    for raw in ({"intent": "delete"}, {"intent": "delete", "query": " "}, {"intent": "delete", "query": "*"},
+                {"intent": "move", "target": "b"}, {"intent": "tag", "tags": ["x"]}):
+        with pytest.raises(ActionError):
+            parse_action(raw)
+    assert parse_action({"intent": "tag", "tags": ["x"], "filename": "a.jpg"}).query == ""
+    assert parse_action({"intent": "delete", "query": "IMG 2019"}).query == "IMG 2019"
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+import io
+import tarfile
+from fastapi.testclient import TestClient
+from app import libraries
+from app.libraries import DEFAULT_TENANT, Library
+from app.main import app
+from app.routes import archives
+
+
+def _members(tmp_path):
+    (tmp_path / "trip").mkdir()
+    members = []
+    for i, size in enumerate([10, 512, 1300]):
+        rel = f"trip/{i}.jpg"
+        (tmp_path / rel).write_bytes(bytes([i + 1]) * size)
+        members.append((f"{i}.jpg", rel, size, 1700000000))
+    return members
+
+
+def test_tar_stream_is_valid_and_ranges_match(tmp_path):
+    members = _members(tmp_path)
+    offsets, total = archives._tar_layout(members)
+    full = b"".join(archives._tar_stream(tmp_path, members, offsets, total, 0, total - 1))
+    assert len(full) == total
+    with tarfile.open(fileobj=io.BytesIO(full)) as tf:
+        assert [(m.name, m.size) for m in tf.getmembers()] == [("0.jpg", 10), ("1.jpg", 512), ("2.jpg", 1300)]
+        assert tf.extractfile("2.jpg").read() == bytes([3]) * 1300
+    for start, end in [(0, 0), (100, 1500), (513, total - 1), (total - 5, total - 1)]:
+        part = b"".join(archives._tar_stream(tmp_path, members, offsets, total, start, end))
+        assert part == full[start:end + 1]
+
+
+def test_parse_range():
+    assert archives._parse_range("bytes=10-", 100) == (10, 99)
+    assert archives._parse_range("bytes=-10", 100) == (90, 99)
+    assert archives._parse_range("bytes=5-500", 100) == (5, 99)
+    assert archives._parse_range("bytes=200-", 100) == "invalid"
+    assert archives._parse_range("items=1-2", 100) is None
+
+
+def test_import_route(tmp_path, monkeypatch):
+    lib = Library(DEFAULT_TENANT, tmp_path)
+    monkeypatch.setattr(libraries, "_loaded", OrderedDict([(DEFAULT_TENANT, lib)]))
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tf:
+        for name, data in [("a.jpg", b"a"), ("sub/b.jpg", b"b"), ("copy.jpg", b"a"), ("notes.txt", b"n")]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    res = TestClient(app).post("/api/import", data={"folder": "trip"}, files={"file": ("x.tar", buf.getvalue())})
+    assert res.json() == {"ok": True, "folder": "/trip", "imported": 2, "duplicate": 1, "skipped": 1}
+    assert sorted(lib.stats.iter_files("trip")) == ["trip/a.jpg", "trip/sub/b.jpg"]
+
+
+def test_export_resume_reuses_the_layout(tmp_path, monkeypatch):
+    lib = Library(DEFAULT_TENANT, tmp_path)
+    monkeypatch.setattr(libraries, "_loaded", OrderedDict([(DEFAULT_TENANT, lib)]))
+    monkeypatch.setattr(archives, "_layouts", OrderedDict())
+    _members(lib.images_root)
+    layouts = []
+    tar_layout = archives._tar_layout
+    monkeypatch.setattr(archives, "_tar_layout", lambda members: layouts.append(1) or tar_layout(members))
+    client = TestClient(app)
+    full = client.get("/api/export?folder=trip")
+    assert full.status_code == 200
+    part = client.get("/api/export?folder=trip", headers={"Range": "bytes=600-", "If-Range": full.headers["etag"]})
+    assert part.status_code == 206
+    assert part.content == full.content[600:]
+    assert len(layouts) == 1
@@ -0,0 +1,87 @@
+import json
+import os
+from app.actions import parse_action
+from app.folder_stats import FolderStats
+from app.libraries import Library, using
+from app.routes import agent
+
+
+def _write(path, data=b"x"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def test_build_rolls_up_hierarchy(tmp_path):
+    _write(tmp_path / "a.jpg", b"12")
+    _write(tmp_path / "trip" / "b.jpg", b"123")
+    _write(tmp_path / "trip" / "day1" / "c.jpg", b"1234")
+    _write(tmp_path / ".trash" / "old.jpg")
+    (tmp_path / "tags.json").write_text(json.dumps({"trip/b.jpg": {"tags": ["beach"]}, "trip/day1/c.jpg": ["beach", "sun"]}))
+    stats = FolderStats(tmp_path)
+    root = stats.get()
+    assert root["files"] == 3
+    assert root["bytes"] == 9
+    trip = stats.get("trip")
+    assert trip["files"] == 2
+    assert trip["direct_files"] == 1
+    assert trip["tags"] == {"beach": 2, "sun": 1}
+    assert stats.get("missing") is None
+
+
+def test_incremental_updates(tmp_path):
+    _write(tmp_path / "src" / "a.jpg", b"12")
+    stats = FolderStats(tmp_path)
+    assert stats.get("src")["files"] == 1
+
+    _write(tmp_path / "src" / "b.jpg", b"1234")
+    stats.add_file(tmp_path / "src" / "b.jpg")
+    stats.set_tags("src/b.jpg", ["x"])
+    assert stats.get("src")["bytes"] == 6
+
+    (tmp_path / "dst").mkdir()
+    (tmp_path / "src" / "b.jpg").rename(tmp_path / "dst" / "b.jpg")
+    stats.move_file(tmp_path / "src" / "b.jpg", tmp_path / "dst" / "b.jpg")
+    assert stats.get("src")["tags"] == {}
+    assert stats.get("dst")["tags"] == {"x": 1}
+
+    stats.move_tree("dst", "src/nested")
+    assert stats.get("dst") is None
+    assert stats.get("src")["files"] == 2
+    stats.remove_tree("src/nested")
+    assert stats.get("src") == {"files": 1, "direct_files": 1, "bytes": 2, "newest_upload": stats.get("src")["newest_upload"], "tags": {}}
+    assert stats.get()["files"] == 1
+
+
+def test_re_adding_a_file_updates_newest(tmp_path):
+    path = _write(tmp_path / "a" / "x.jpg")
+    os.utime(path, (2000000000, 2000000000))
+    stats = FolderStats(tmp_path)
+    assert stats.get("a")["newest_upload"].startswith("2033")
+    os.utime(path, (1000000000, 1000000000))
+    stats.add_file(path)
+    newest = stats.get("a")["newest_upload"]
+    stats.invalidate()
+    assert newest == stats.get("a")["newest_upload"]
+    assert newest.startswith("2001")
+
+
+def test_tags_agree_with_rebuild_after_move_and_restore(tmp_path):
+    lib = Library("test", tmp_path)
+    _write(lib.images_root / "a" / "x.jpg")
+    (lib.images_root / "tags.json").write_text(json.dumps({"a/x.jpg": {"tags": ["cat"]}}))
+    with using(lib):
+        rename = parse_action({"intent": "rename", "folder": "a", "old_name": "x.jpg", "new_name": "y.jpg"})
+        assert agent.perform_action(rename)["ok"]
+        assert lib.stats.get("a")["tags"] == {"cat": 1}
+        lib.stats.invalidate()
+        assert lib.stats.get("a")["tags"] == {"cat": 1}
+
+        delete = parse_action({"intent": "delete", "query": "y"})
+        assert agent.perform_action(delete)["deleted"] == 1
+        assert lib.stats.get("a")["tags"] == {}
+        assert agent._undo_last().status_code == 200
+        assert lib.stats.get("a")["tags"] == {"cat": 1}
+        assert list(lib.trash_dir.iterdir()) == []
+        lib.stats.invalidate()
+        assert lib.stats.get("a")["tags"] == {"cat": 1}
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+from fastapi.testclient import TestClient
+from app import libraries
+from app.main import app
+
+client = TestClient(app)
+
+
+def _tenants(tmp_path, monkeypatch, size=16):
+    monkeypatch.setattr(libraries, "_loaded", OrderedDict())
+    monkeypatch.setattr(libraries, "LIBRARY_CACHE_SIZE", size)
+    monkeypatch.setattr(libraries, "tenant_dir", lambda tenant: tmp_path / tenant)
+    monkeypatch.setattr(libraries, "TENANTS", frozenset({"alice", "bob"}))
+    monkeypatch.setattr(libraries, "TENANT_PROXY_TOKEN", "s3cret")
+
+
+def test_idle_libraries_are_evicted(tmp_path, monkeypatch):
+    _tenants(tmp_path, monkeypatch, size=2)
+    a = libraries.get_library("a")
+    b = libraries.get_library("b")
+    assert libraries.get_library("a") is a
+    libraries.get_library("c")
+    assert list(libraries._loaded) == ["a", "c"]
+    assert libraries.get_library("b") is not b
+
+
+def test_requests_only_see_their_library(tmp_path, monkeypatch):
+    _tenants(tmp_path, monkeypatch)
+    alice = {"X-Tenant": "alice", "X-Tenant-Token": "s3cret"}
+    bob = {"X-Tenant": "bob", "X-Tenant-Token": "s3cret"}
+    assert client.post("/api/create_folder", data={"name": "trip"}, headers=alice).json()["ok"]
+    (tmp_path / "alice" / "images" / "trip" / "a.png").write_bytes(b"png")
+    assert client.get("/gallery?folder=trip", headers=alice).status_code == 200
+    assert client.get("/gallery?folder=trip", headers=bob).status_code == 404
+    assert client.get("/images/trip/a.png", headers=alice).content == b"png"
+    assert client.get("/images/trip/a.png", headers=bob).status_code == 404
+    assert client.get("/images/../alice/images/trip/a.png", headers=bob).status_code == 404
+    assert client.get("/gallery", headers={"X-Tenant": "../x"}).status_code == 400
+
+
+def test_only_known_tenants_via_the_proxy(tmp_path, monkeypatch):
+    _tenants(tmp_path, monkeypatch)
+    assert client.get("/gallery", headers={"X-Tenant": "alice"}).status_code == 403
+    assert client.get("/gallery", headers={"X-Tenant": "alice", "X-Tenant-Token": "guess"}).status_code == 403
+    assert client.get("/gallery", headers={"X-Tenant": "mallory", "X-Tenant-Token": "s3cret"}).status_code == 404
+    assert not (tmp_path / "mallory").exists()
+    (tmp_path / "carol").mkdir()
+    assert client.get("/gallery", headers={"X-Tenant": "carol", "X-Tenant-Token": "s3cret"}).status_code == 200
+    assert "mallory" not in libraries._loaded
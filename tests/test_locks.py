@@ -0,0 +1,103 @@
+from collections import OrderedDict
+import threading
+import time
+from fastapi.testclient import TestClient
+from app import catalog
+from app import libraries
+from app import locks
+from app.libraries import DEFAULT_TENANT, Library, using
+from app.main import app
+
+
+def _try_in_thread(**scope):
+    # returns an Event that is set once the thread got the locks
+    got = threading.Event()
+    release = threading.Event()
+
+    def run():
+        with locks.locked(**scope):
+            got.set()
+            release.wait(5)
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return got, release, t
+
+
+def test_tree_lock_blocks_descendants_but_not_siblings(tmp_path):
+    lib = Library("test", tmp_path)
+    with locks.locked(trees=["lock-a"], library=lib):
+        child, child_release, child_t = _try_in_thread(files_in=["lock-a/sub"], library=lib)
+        sibling, sibling_release, sibling_t = _try_in_thread(files_in=["lock-b"], library=lib)
+        assert sibling.wait(2)
+        time.sleep(0.2)
+        assert not child.is_set()
+    assert child.wait(2)
+    child_release.set()
+    sibling_release.set()
+    child_t.join(2)
+    sibling_t.join(2)
+
+
+def test_other_workers_replay_the_journal(tmp_path):
+    # two Library objects on one directory behave like two workers
+    one, two = Library("test", tmp_path), Library("test", tmp_path)
+    (one.images_root / "a.jpg").write_bytes(b"x")
+    assert two.stats.get()["files"] == 1
+    tree = two.stats._tree
+    (one.images_root / "b.jpg").write_bytes(b"xy")
+    with using(one):
+        catalog.add_file(one.images_root / "b.jpg")
+    assert two.journal.behind()
+    two.sync()
+    assert two.stats._tree is tree  # applied in place, not rebuilt
+    assert two.stats.get()["bytes"] == 3
+    assert one.journal.position() == two.journal.position() == 1
+
+
+def test_journal_rotates_and_lagging_workers_rebuild(tmp_path, monkeypatch):
+    monkeypatch.setattr(locks, "JOURNAL_SEGMENT_BYTES", 64)
+    monkeypatch.setattr(locks, "JOURNAL_SEGMENTS_KEPT", 2)
+    one, two, lagging = (Library("test", tmp_path) for _ in range(3))
+    lagging.stats.get()
+    with using(one):
+        for i in range(4):
+            catalog.add_folder(f"folder-{i}")
+            two.sync()
+        assert two.stats.has_folder("folder-3")
+        assert two.journal.position() == 4
+        for i in range(4, 20):
+            catalog.add_folder(f"folder-{i}")
+    assert len(list((tmp_path / "locks" / "journal").glob("*.log"))) == 2
+    lagging.sync()
+    assert lagging.stats._tree is None
+    assert lagging.journal.position() == 20
+    assert [args for _op, args in one.journal.since(18)] == [["folder-18"], ["folder-19"]]
+    assert one.journal.since(0) is None
+
+
+def test_libraries_do_not_share_locks(tmp_path):
+    a, b = Library("a", tmp_path / "a"), Library("b", tmp_path / "b")
+    with locks.locked(trees=[""], library=a):
+        got, release, t = _try_in_thread(trees=[""], library=b)
+        assert got.wait(2)
+    release.set()
+    t.join(2)
+
+
+def test_waiting_for_a_lock_does_not_stall_other_requests(tmp_path, monkeypatch):
+    lib = Library(DEFAULT_TENANT, tmp_path)
+    monkeypatch.setattr(libraries, "_loaded", OrderedDict([(DEFAULT_TENANT, lib)]))
+    (lib.images_root / "trip").mkdir()
+    with TestClient(app) as client:  # one event loop for every request
+        with locks.locked(trees=["trip"], library=lib):
+            waiting = threading.Thread(target=client.post, args=("/gallery/trip/delete",), kwargs={"follow_redirects": False})
+            waiting.start()
+            time.sleep(0.2)
+            other = threading.Thread(target=client.get, args=("/api/timeline",))
+            other.start()
+            other.join(2)
+            assert not other.is_alive()
+            assert waiting.is_alive()
+        waiting.join(2)
+    assert not (lib.images_root / "trip").exists()
@@ -0,0 +1,98 @@
+import random
+import threading
+import time
+import numpy as np
+from PIL import Image
+from app.actions import parse_action
+from app import phash
+from app.folder_stats import FolderStats
+from app.libraries import Library, using
+from app.phash import PHashIndex, compute_phash
+from app.routes import agent
+
+
+def _blocks(path, size, seed=0):
+    # coarse random blocks survive resizing/recompression like a real photo would
+    rnd = random.Random(seed)
+    img = Image.new('L', (8, 6))
+    img.putdata([rnd.randrange(256) for _ in range(48)])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    img.resize(size, Image.BILINEAR).convert('RGB').save(path)
+
+
+def _index(tmp_path):
+    root = tmp_path / "images"
+    return root, PHashIndex(root, tmp_path / "phash.npz", FolderStats(root))
+
+
+def test_near_duplicates_grouped(tmp_path):
+    root, index = _index(tmp_path)
+    _blocks(root / "a.png", (128, 96))
+    _blocks(root / "trip" / "a_small.png", (64, 48))
+    _blocks(root / "trip" / "other.png", (128, 96), seed=1)
+    assert compute_phash(root / "a.png") is not None
+    assert index.backfill() == 3
+    assert index.duplicates() == [["a.png", "trip/a_small.png"]]
+    assert index.duplicates("trip") == []
+    similar = index.similar("a.png")
+    assert similar[0]["file"] == "trip/a_small.png"
+    assert (tmp_path / "phash.npz").exists()
+
+
+def test_hooks_track_moves_and_uploads(tmp_path):
+    root, index = _index(tmp_path)
+    _blocks(root / "a.png", (128, 96))
+    index.backfill()
+    assert index.duplicates() == []
+    _blocks(root / "b.png", (200, 150))
+    index.stats.add_file(root / "b.png")
+    index.add_file(root / "b.png").result()
+    (root / "x").mkdir()
+    (root / "b.png").rename(root / "x" / "b.png")
+    index.move_file("b.png", "x/b.png")
+    assert index.duplicates() == [["a.png", "x/b.png"]]
+    index.remove_file("x/b.png")
+    assert index.similar("a.png") == []
+
+
+def test_queries_do_not_wait_for_hashing(tmp_path, monkeypatch):
+    root, index = _index(tmp_path)
+    _blocks(root / "a.png", (128, 96))
+    _blocks(root / "b.png", (64, 48))
+    release = threading.Event()
+    monkeypatch.setattr(phash, "compute_phash", lambda path: release.wait(5) and compute_phash(path))
+    assert index.duplicates() == []
+    release.set()
+    for _ in range(100):
+        if index.duplicates():
+            break
+        time.sleep(0.05)
+    assert index.duplicates() == [["a.png", "b.png"]]
+    assert (tmp_path / "phash.npz").exists()
+
+
+def test_pairs_match_brute_force():
+    rnd = np.random.default_rng(0)
+    base = rnd.integers(0, 2 ** 63, size=300, dtype=np.uint64)
+    flips = np.uint64(1) << rnd.integers(0, 64, size=300).astype(np.uint64)
+    hashes = np.unique(np.r_[base, base[:100] ^ flips[:100], base[:50] ^ flips[50:100] ^ flips[100:150]])
+    a, b = phash._close_pairs(hashes, 3)
+    found = {(min(x, y), max(x, y)) for x, y in zip(a.tolist(), b.tolist())}
+    expected = {(i, j) for i in range(len(hashes)) for j in range(i + 1, len(hashes))
+                if bin(int(hashes[i]) ^ int(hashes[j])).count('1') <= 3}
+    assert found == expected
+    label = phash._components(4, np.array([3, 1]), np.array([2, 0]))
+    assert label.tolist() == [0, 0, 2, 2]
+
+
+def test_trashed_duplicates_keep_their_paths(tmp_path):
+    lib = Library("test", tmp_path)
+    for folder, data in (("b", b"from b"), ("c", b"from c")):
+        (lib.images_root / folder).mkdir()
+        (lib.images_root / folder / "IMG.jpg").write_bytes(data)
+    with using(lib):
+        action = parse_action({"intent": "delete_duplicates"})
+        assert agent._delete_to_trash(action, ["b/IMG.jpg", "c/IMG.jpg"])["deleted"] == 2
+        agent._undo_last()
+    assert (lib.images_root / "b" / "IMG.jpg").read_bytes() == b"from b"
+    assert (lib.images_root / "c" / "IMG.jpg").read_bytes() == b"from c"
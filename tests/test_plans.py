@@ -0,0 +1,97 @@
+import json
+import pytest
+from app import catalog
+from app import plans
+from app.actions import action_dict, parse_action
+from app.libraries import Library, using
+from app.routes import agent
+
+
+@pytest.fixture
+def lib(tmp_path):
+    lib = Library("test", tmp_path)
+    (lib.images_root / "a").mkdir()
+    for name in ("x1.jpg", "x2.jpg"):
+        (lib.images_root / "a" / name).write_bytes(b"x")
+    with using(lib):
+        yield lib
+
+
+def test_confirm_runs_stored_plan_once(lib):
+    root = lib.images_root
+    action = parse_action({"source_folder": "a", "target_folder": "b"})
+    preview, items = agent.preview_action(action)
+    assert preview["preview"]["move_count"] == 2
+    plan = plans.create(action_dict(action), items, preview, plans.position())
+    result, _raw = agent._run_plan(plan["id"])
+    assert result["moved"] == 2
+    assert sorted(p.name for p in (root / "b").iterdir()) == ["x1.jpg", "x2.jpg"]
+    again, _raw = agent._run_plan(plan["id"])
+    assert again["ok"] is False
+
+
+def test_stale_plan_drops_vanished_files(lib):
+    root = lib.images_root
+    action = parse_action({"source_folder": "a", "target_folder": "b"})
+    preview, items = agent.preview_action(action)
+    plan = plans.create(action_dict(action), items, preview, plans.position())
+    (root / "a" / "x2.jpg").unlink()
+    (root / "a" / "x3.jpg").write_bytes(b"x")  # not previewed, so not moved
+    catalog.remove_file(root / "a" / "x2.jpg")
+    result, _raw = agent._run_plan(plan["id"])
+    assert result["moved"] == 1
+    assert result["skipped"] == ["a/x2.jpg"]
+    assert (root / "a" / "x3.jpg").exists()
+
+
+def test_unknown_or_expired_plans(lib, monkeypatch):
+    assert plans.take("../etc/passwd") is None
+    plan = plans.create({"intent": "summarize"}, None, {"ok": True}, plans.position())
+    monkeypatch.setattr(plans, "PLAN_TTL", -1)
+    assert plans.take(plan["id"]) is None
+
+
+def test_query_never_matches_hidden_files(lib):
+    (lib.trash_dir / "b1").mkdir()
+    (lib.trash_dir / "b1" / "x9.jpg").write_bytes(b"x")
+    preview, items = agent.preview_action(parse_action({"intent": "move", "query": "x", "target": "b"}))
+    assert [src for src, _dst in items] == ["a/x1.jpg", "a/x2.jpg"]
+
+
+def test_plan_skips_destinations_taken_since_preview(lib):
+    root = lib.images_root
+    action = parse_action({"source_folder": "a", "target_folder": "b"})
+    preview, items = agent.preview_action(action)
+    plan = plans.create(action_dict(action), items, preview, plans.position())
+    (root / "b").mkdir()
+    (root / "b" / "x1.jpg").write_bytes(b"keep")
+    result, _raw = agent._run_plan(plan["id"])
+    assert result["moved"] == 1
+    assert (root / "b" / "x1.jpg").read_bytes() == b"keep"
+    assert (root / "a" / "x1.jpg").exists()
+
+
+def test_confirming_a_bare_action_only_previews_it(lib):
+    req = agent.ChatRequest(confirm=True, action={"source_folder": "a", "target_folder": "b"})
+    body = json.loads(agent._confirm(req).body)
+    assert body["requires_confirmation"] and body["plan_id"]
+    assert not (lib.images_root / "b").exists()
+
+
+def test_only_changed_items_are_checked_again(lib, monkeypatch):
+    root = lib.images_root
+    (root / "c").mkdir()
+    (root / "c" / "new.jpg").write_bytes(b"x")
+    action = parse_action({"source_folder": "a", "target_folder": "b"})
+    preview, items = agent.preview_action(action)
+    plan = plans.create(action_dict(action), items, preview, plans.position())
+    catalog.add_file(root / "c" / "new.jpg")
+    (root / "a" / "x2.jpg").unlink()
+    catalog.remove_file(root / "a" / "x2.jpg")
+    checked = []
+    still_there = agent._still_there
+    monkeypatch.setattr(agent, "_still_there", lambda rel: checked.append(rel) or still_there(rel))
+    kept, dropped = agent.revalidate_items(plan["items"], plans.changes(plan))
+    assert checked == ["a/x2.jpg"]
+    assert [src for src, _dst in kept] == ["a/x1.jpg"]
+    assert [src for src, _dst in dropped] == ["a/x2.jpg"]
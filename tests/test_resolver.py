@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import pytest
+from fastapi.testclient import TestClient
+from app import libraries
+from app.libraries import DEFAULT_TENANT, Library, using
+from app.main import app
+from app.resolver import clean_filename, clean_folder, folder_ref, image_ref
+
+
+def test_names_are_normalized_and_traversal_rejected():
+    assert clean_folder(" a\\b//c/ ") == "a/b/c"
+    assert clean_folder("a/../b") is None
+    assert clean_folder(".trash/x") is None
+    assert clean_filename("x.jpg") == "x.jpg"
+    assert clean_filename("../x.jpg") is None
+    assert clean_filename(".ai_action_log.jsonl") is None
+
+
+def test_handles():
+    assert folder_ref(None).folder == ""
+    assert folder_ref("/").folder == ""
+    assert folder_ref("..") is None
+    ref = image_ref("trip/day1", "a.jpg")
+    assert ref.rel == "trip/day1/a.jpg"
+    assert ref.url == "/images/trip/day1/a.jpg"
+    assert ref.with_name("b.jpg").rel == "trip/day1/b.jpg"
+    assert ref.with_name("../b.jpg") is None
+    assert image_ref("../etc", "passwd") is None
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # requests without a tenant header use a library in tmp_path
+    lib = Library(DEFAULT_TENANT, tmp_path)
+    monkeypatch.setattr(libraries, "_loaded", OrderedDict([(DEFAULT_TENANT, lib)]))
+    (lib.images_root / "trip").mkdir()
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        (lib.images_root / "trip" / name).write_bytes(b"jpg")
+    return TestClient(app)
+
+
+def test_image_routes_reach_files(client, tmp_path):
+    trip = tmp_path / "images" / "trip"
+    assert client.get("/api/image_exif", params={"folder": "trip", "filename": "a.jpg"}).json() == {"exif": {}}
+    assert client.get("/api/image_exif", params={"folder": "trip", "filename": "x.jpg"}).status_code == 404
+    res = client.post("/api/rename_image", json={"folder": "trip", "old_name": "a.jpg", "new_name": "d"})
+    assert res.json() == {"ok": True, "new_name": "d.jpg"}
+    assert (trip / "d.jpg").exists() and not (trip / "a.jpg").exists()
+    assert client.post("/api/delete_image", json={"folder": "trip", "filename": "b.jpg"}).json() == {"ok": True}
+    assert not (trip / "b.jpg").exists()
+    res = client.post("/gallery/trip/delete_image", data={"filename": "c.jpg"}, follow_redirects=False)
+    assert res.status_code == 303
+    assert sorted(p.name for p in trip.iterdir()) == ["d.jpg"]
+
+
+def test_tags_file_is_not_an_image(client, tmp_path):
+    tags = tmp_path / "images" / "tags.json"
+    tags.write_text('{"trip/d.jpg": {"tags": ["x"]}}')
+    assert image_ref(None, "tags.json", root=tmp_path / "images") is None
+    assert image_ref("trip", "tags.json", root=tmp_path / "images") is not None
+    assert client.post("/api/rename_image", json={"old_name": "tags.json", "new_name": "t.jpg"}).json()["ok"] is False
+    assert client.post("/api/delete_image", json={"filename": "tags.json"}).json()["ok"] is False
+    assert tags.read_text() == '{"trip/d.jpg": {"tags": ["x"]}}'
+
+
+def test_lookups_stay_in_memory(tmp_path, monkeypatch):
+    lib = Library("test", tmp_path)
+    (lib.images_root / "a.jpg").write_bytes(b"jpg")
+    lib.stats.get()
+    monkeypatch.setattr(lib.journal, "sync", lambda: pytest.fail("journal read on lookup"))
+    with using(lib):
+        assert image_ref(None, "a.jpg").exists()
+        assert folder_ref("").exists()
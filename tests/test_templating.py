@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from fastapi.testclient import TestClient
+from app import libraries
+from app.libraries import DEFAULT_TENANT, Library
+from app.main import app
+from app.templating import FragmentCache
+
+
+def test_versions_follow_mutations(tmp_path):
+    cache = FragmentCache(tmp_path, 1024)
+    before = (cache.version("trip"), cache.version("trip/day1", direct=True), cache.version("other"))
+    cache.add_file(tmp_path / "trip" / "day1" / "a.jpg")
+    assert cache.version("trip") != before[0]
+    assert cache.version("trip/day1", direct=True) != before[1]
+    assert cache.version("trip", direct=True) == (0, 0)
+    assert cache.version("other") == before[2]
+    calls = []
+    render = lambda: calls.append(1) or "<p>x</p>"
+    v = cache.version("trip")
+    assert cache.get_or_render("k", v, render) == cache.get_or_render("k", v, render)
+    assert len(calls) == 1
+    cache.move_file(tmp_path / "trip" / "a.jpg", tmp_path / "b.jpg")
+    cache.get_or_render("k", cache.version("trip"), render)
+    assert len(calls) == 2
+
+
+def test_lru_is_bounded(tmp_path):
+    cache = FragmentCache(tmp_path, 100)
+    for i in range(10):
+        cache.get_or_render(i, (0, 0), lambda: "x" * 30)
+    assert cache._bytes <= 100
+    assert list(cache._entries) == [7, 8, 9]
+
+
+def test_gallery_conditional_get(tmp_path, monkeypatch):
+    lib = Library(DEFAULT_TENANT, tmp_path)
+    monkeypatch.setattr(libraries, "_loaded", OrderedDict([(DEFAULT_TENANT, lib)]))
+    client = TestClient(app)
+    first = client.get("/gallery")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    again = client.get("/gallery", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag
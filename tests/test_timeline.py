@@ -0,0 +1,97 @@
+import calendar
+import json
+import os
+import threading
+import time
+from app import timeline as timeline_module
+from app.folder_stats import FolderStats
+from app.timeline import TimelineIndex, decode_cursor
+
+
+def _ts(s):
+    return calendar.timegm(tuple(int(x) for x in s.replace('-', ' ').replace(':', ' ').split()) + (0, 0, 0))
+
+
+def _image(root, rel, when):
+    path = root / rel
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"not a real jpeg")
+    os.utime(path, (_ts(when), _ts(when)))
+    return path
+
+
+def _index(tmp_path):
+    root = tmp_path / "images"
+    _image(root, "trip/a.jpg", "2023-07-01 10:00:00")
+    _image(root, "trip/b.jpg", "2023-07-01 12:00:00")
+    _image(root, "trip/c.jpg", "2023-07-02 09:00:00")
+    _image(root, "d.jpg", "2024-01-05 08:00:00")
+    (root / "notes.txt").write_text("x")
+    stats = FolderStats(root)
+    return root, stats, TimelineIndex(root, tmp_path / "timeline.bin", stats)
+
+
+def test_buckets_and_counts(tmp_path):
+    _root, _stats, timeline = _index(tmp_path)
+    assert timeline.buckets() == [{"bucket": "2024", "count": 1}, {"bucket": "2023", "count": 3}]
+    assert timeline.buckets("2023") == [{"bucket": "2023-07", "count": 3}]
+    assert timeline.buckets("2023-07") == [{"bucket": "2023-07-02", "count": 1}, {"bucket": "2023-07-01", "count": 2}]
+    assert timeline.count() == 4
+    assert timeline.count("2023-07-01") == 2
+
+
+def test_paging_crosses_days(tmp_path):
+    _root, _stats, timeline = _index(tmp_path)
+    seen = []
+    cursor = None
+    while True:
+        items, next_cursor = timeline.page("2023", cursor and decode_cursor(cursor), limit=2)
+        seen += [i["file"] for i in items]
+        if next_cursor is None:
+            break
+        cursor = next_cursor
+    assert seen == ["trip/c.jpg", "trip/b.jpg", "trip/a.jpg"]
+    items, next_cursor = timeline.page("2023-07-01", limit=2)
+    assert [i["taken"] for i in items] == ["2023-07-01T12:00:00", "2023-07-01T10:00:00"]
+    assert next_cursor is None
+
+
+def test_incremental_updates(tmp_path):
+    root, stats, timeline = _index(tmp_path)
+    timeline.count()
+    new = _image(root, "e.jpg", "2022-03-03 03:00:00")
+    stats.add_file(new)
+    timeline.add_file(new)
+    assert timeline.count("2022-03-03") == 1
+    (root / "old").mkdir()
+    os.replace(new, root / "old" / "e.jpg")
+    stats.move_file(new, root / "old" / "e.jpg")
+    timeline.move_file(new, root / "old" / "e.jpg")
+    assert timeline.page("2022")[0][0]["file"] == "old/e.jpg"
+    timeline.remove_tree(root / "trip")
+    assert timeline.buckets() == [{"bucket": "2024", "count": 1}, {"bucket": "2022", "count": 1}]
+    timeline.save()
+    reloaded = TimelineIndex(root, tmp_path / "timeline.bin", stats)
+    assert reloaded.count("2022-03-03") == 1
+
+
+def test_uploaded_at_before_mtime(tmp_path):
+    root = tmp_path / "images"
+    _image(root, "up.jpg", "2024-06-01 00:00:00")
+    (root / "tags.json").write_text(json.dumps({"up.jpg": {"tags": [], "uploaded_at": "2021-02-03T04:05:06.789Z"}}))
+    timeline = TimelineIndex(root, tmp_path / "timeline.bin", FolderStats(root))
+    assert timeline.buckets() == [{"bucket": "2021", "count": 1}]
+
+
+def test_queries_do_not_wait_for_exif(tmp_path, monkeypatch):
+    root, _stats, timeline = _index(tmp_path)
+    release = threading.Event()
+    monkeypatch.setattr(timeline_module, "_exif_time", lambda path: release.wait(5) and _ts("2020-01-01 00:00:00"))
+    assert timeline.count("2023") == 3
+    release.set()
+    for _ in range(100):
+        if timeline.count("2020") == 4 and (tmp_path / "timeline.bin").exists():
+            break
+        time.sleep(0.05)
+    assert timeline.buckets() == [{"bucket": "2020", "count": 4}]
+    assert TimelineIndex(root, tmp_path / "timeline.bin", FolderStats(root)).count("2020") == 4